@@ -0,0 +1,68 @@
+import logging
+import time
+
+import fenics as fe
+import numpy as np
+
+from argparse import ArgumentParser
+from statfenics.utils import build_observation_operator
+from swe_filter import ShallowOneKalman
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+fe.set_log_level(40)
+np.random.seed(27)
+
+
+def benchmark_update(swe, nx_obs, sigma_y=5e-2, n_repeats=10):
+    """ Time each update form (from the same prior) for `nx_obs` observations. """
+    idx_obs = np.linspace(0, swe.n_vertices - 1, nx_obs, dtype="int")
+    H = build_observation_operator(swe.x_coords[idx_obs], swe.W, sub=1, out="scipy")
+    y = H @ swe.mean + sigma_y * np.random.normal(size=(nx_obs, ))
+
+    mean, cov_sqrt = swe.mean.copy(), swe.cov_sqrt.copy()
+    timings = dict()
+    for form in ["batch", "woodbury", "serial"]:
+        swe.update_form = form
+        start_time = time.perf_counter()
+        for i in range(n_repeats):
+            swe.du.vector().set_local(mean)
+            swe.cov_sqrt[:] = cov_sqrt
+            swe.assimilate(y, H, sigma_y)
+
+        timings[form] = (time.perf_counter() - start_time) / n_repeats
+
+    swe.du.vector().set_local(mean)
+    swe.cov_sqrt[:] = cov_sqrt
+    return timings
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--nx", type=int, default=500)
+    parser.add_argument("--k", type=int, default=32)
+    parser.add_argument("--nx_obs", nargs="+", type=int,
+                        default=[1, 5, 10, 50, 100, 250, 501])
+    parser.add_argument("--n_repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    control = dict(nx=args.nx, dt=1., theta=0.6, simulation="tidal_flow")
+    params = dict(nu=1., shore_start=2000., shore_height=5.,
+                  bump_height=0., bump_centre=8000., bump_width=400)
+    stat_params = dict(rho_u=0., ell_u=1000., rho_h=2e-3, ell_h=1000.,
+                       k=args.k, k_init_u=args.k, k_init_h=args.k,
+                       hilbert_gp=True)
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+
+    # spin up the covariance so that the prior is full-rank
+    t = 0.
+    for i in range(2 * args.k):
+        t += swe.dt
+        swe.prediction_step(t)
+        swe.set_prev()
+
+    logger.info("%8s %12s %12s %12s", "nx_obs", "batch", "woodbury", "serial")
+    for nx_obs in args.nx_obs:
+        timings = benchmark_update(swe, nx_obs, n_repeats=args.n_repeats)
+        logger.info("%8d %12.3e %12.3e %12.3e", nx_obs,
+                    timings["batch"], timings["woodbury"], timings["serial"])
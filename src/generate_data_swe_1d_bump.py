@@ -1,9 +1,9 @@
 import logging
-import xarray as xr
 import numpy as np
 
 from argparse import ArgumentParser
 from fenics import set_log_level
+from netCDF4 import Dataset
 from swe import ShallowOne
 from tqdm import tqdm
 
@@ -14,12 +14,65 @@ logger = logging.getLogger(__name__)
 parser = ArgumentParser()
 parser.add_argument("--add_noise", action="store_true")
 parser.add_argument("--output_file", type=str)
+parser.add_argument("--t_final", type=float, default=24 * 60 * 60)
+parser.add_argument("--nx", type=int, default=500)
+parser.add_argument("--thin_t", type=int, default=1)  # keep every thin_t'th step
+parser.add_argument("--thin_x", type=int, default=1)  # keep every thin_x'th vertex
 args = parser.parse_args()
 
 SIGMA_Y = 5e-2
-T_FINAL = 24 * 60 * 60
+T_FINAL = args.t_final
 
-settings = dict(nx=500, dt=1., theta=0.6, nu=1., shore_start=2000)
+# outputs are appended to the file in blocks of BLOCK_SIZE times (chunked
+# along time in CHUNK_SIZE'd pieces), so memory use doesn't grow with the run
+BLOCK_SIZE = 1024
+CHUNK_SIZE = 256
+
+
+class BlockWriter:
+    """ Append time blocks of `u` and `h` to a compressed NetCDF file. """
+    def __init__(self, output_file, x, attrs):
+        self.nx = len(x)
+        self.n_buffered = 0
+        self.n_written = 0
+        self.t = np.zeros((BLOCK_SIZE, ))
+        self.fields = {name: np.zeros((BLOCK_SIZE, self.nx)) for name in ["u", "h"]}
+
+        self.out = Dataset(output_file, "w")
+        self.out.setncatts(attrs)
+        self.out.createDimension("t", None)
+        self.out.createDimension("x", self.nx)
+        self.out.createVariable("t", "f8", ("t", ))
+        self.out.createVariable("x", "f8", ("x", ))[:] = x
+        for name in self.fields:
+            var = self.out.createVariable(name, "f8", ("t", "x"),
+                                          zlib=True, complevel=4, shuffle=True,
+                                          chunksizes=(CHUNK_SIZE, self.nx))
+            var.setncatts(attrs)
+
+    def append(self, t, u, h):
+        self.t[self.n_buffered] = t
+        self.fields["u"][self.n_buffered, :] = u
+        self.fields["h"][self.n_buffered, :] = h
+        self.n_buffered += 1
+        if self.n_buffered == BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        start, end = self.n_written, self.n_written + self.n_buffered
+        self.out["t"][start:end] = self.t[:self.n_buffered]
+        for name, field in self.fields.items():
+            self.out[name][start:end, :] = field[:self.n_buffered, :]
+
+        self.out.sync()
+        self.n_written, self.n_buffered = end, 0
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+
+settings = dict(nx=args.nx, dt=1., theta=0.6, nu=1., shore_start=2000)
 control = dict(nx=settings["nx"],
                dt=settings["dt"],
                theta=0.6,
@@ -37,35 +90,32 @@ logger.info(params)
 # set the observation system
 nt = np.int64(np.round(T_FINAL / settings["dt"]))
 t_grid = np.linspace(0., T_FINAL, nt + 1)
+n_vertices = settings["nx"] + 1
 
-# store outputs
-u_obs = np.zeros((nt + 1, settings["nx"] + 1))  # include step for final time
-h_obs = np.zeros((nt + 1, settings["nx"] + 1))  # include step for final time
-u_obs[0, :] = swe_dgp.du.compute_vertex_values()[:(settings["nx"] + 1)]
-h_obs[0, :] = swe_dgp.du.compute_vertex_values()[(settings["nx"] + 1):]
+# store outputs (include step for final time)
+logger.info("storing outputs into %s", args.output_file)
+writer = BlockWriter(args.output_file,
+                     swe_dgp.x_coords.flatten()[::args.thin_x],
+                     {**settings, **params, "thin_t": args.thin_t, "thin_x": args.thin_x})
+vertex_values = swe_dgp.du.compute_vertex_values()
+writer.append(t_grid[0],
+              vertex_values[:n_vertices][::args.thin_x],
+              vertex_values[n_vertices:][::args.thin_x])
 
 t = 0.
 logger.info("starting SWE run")
 for i in tqdm(range(nt)):
     t += swe_dgp.dt
     swe_dgp.solve(t)
-    u_obs[i + 1, :] = swe_dgp.du.compute_vertex_values()[:(settings["nx"] + 1)]
-    h_obs[i + 1, :] = swe_dgp.du.compute_vertex_values()[(settings["nx"] + 1):]
+    if (i + 1) % args.thin_t != 0:
+        continue
 
+    vertex_values = swe_dgp.du.compute_vertex_values()
+    u_obs = vertex_values[:n_vertices][::args.thin_x]
+    h_obs = vertex_values[n_vertices:][::args.thin_x]
     if args.add_noise:
-        h_obs[i + 1, :] += SIGMA_Y * np.random.normal(
-            size=h_obs[i + 1, :].shape)
-
-# HACK(connor): autoconvert to dataset
-u_out = xr.DataArray(data=u_obs,
-                     coords=dict(t=t_grid, x=swe_dgp.x_coords.flatten()),
-                     attrs={**settings, **params},
-                     name="u")
-h_out = xr.DataArray(data=h_obs,
-                     coords=dict(t=t_grid, x=swe_dgp.x_coords.flatten()),
-                     attrs={**settings, **params},
-                     name="h")
-out = xr.merge([u_out, h_out])
+        h_obs = h_obs + SIGMA_Y * np.random.normal(size=h_obs.shape)
 
-logger.info("storing outputs into %s", args.output_file)
-out.to_netcdf(args.output_file)
+    writer.append(t_grid[i + 1], u_obs, h_obs)
+
+writer.close()
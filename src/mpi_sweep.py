@@ -0,0 +1,166 @@
+""" Parameter sweeps over MPI: a work queue on rank 0, serial jobs on the rest. """
+import logging
+import time
+
+from collections import Counter, deque
+
+# initialise the logger
+logger = logging.getLogger(__name__)
+
+
+class Cancelled(Exception):
+    """ Raised (by `check_cancel`) in a job that rank 0 has cancelled. """
+
+
+def mpi_sweep(jobs, costs, run, straggler_factor=3., poll_interval=0.5):
+    """ Run `run(job, check_cancel)` for each of `jobs`, spread across the MPI ranks.
+
+    Rank 0 hands out jobs (in the given order) as the worker ranks ask for
+    them, and yields `(j, rank, out, elapsed, first)` for each finished job
+    `j`. `jobs` and `costs` are only needed on rank 0; the other ranks
+    return `None` once they are told to stop.
+
+    Stragglers: once the queue is empty, an idle rank is given a duplicate
+    of a running job that has taken more than `straggler_factor` times its
+    expected time (from `costs`, and the time per unit cost of the jobs
+    done so far). Whichever copy finishes first has `first=True`, and the
+    other is cancelled: jobs should call `check_cancel()` regularly (e.g.
+    every step), which raises `Cancelled` once their copy is superseded.
+    The other copy is yielded too (with `first=False`, and `out=None` if it
+    was cancelled), so that the caller can throw away its results.
+    """
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    if comm.Get_size() < 2:
+        raise ValueError("MPI sweeps need at least 2 ranks (rank 0 schedules)")
+
+    if comm.Get_rank() == 0:
+        return schedule(comm, jobs, costs, straggler_factor, poll_interval, MPI)
+    else:
+        work(comm, run)
+
+
+def work(comm, run):
+    """ Worker loop: ask rank 0 for jobs until told to stop. """
+    comm.send(("ready", ), dest=0)
+    while True:
+        msg = comm.recv(source=0)
+        if msg[0] == "stop":
+            break
+        elif msg[0] == "cancel":
+            # the job had already finished when it was cancelled
+            continue
+
+        _, j, job = msg
+
+        def check_cancel():
+            # rank 0 only messages busy ranks to cancel their job
+            if comm.Iprobe(source=0):
+                msg = comm.recv(source=0)
+                if msg == ("cancel", j):
+                    raise Cancelled("job {:d} was cancelled".format(j))
+
+        start_time = time.time()
+        try:
+            out = run(job, check_cancel)
+        except Cancelled:
+            logger.info("job %d cancelled on rank %d", j, comm.Get_rank())
+            comm.send(("cancelled", j, time.time() - start_time), dest=0)
+        except Exception as e:
+            logger.exception("job %d failed on rank %d", j, comm.Get_rank())
+            comm.send(("error", j, repr(e)), dest=0)
+        else:
+            comm.send(("done", j, out, time.time() - start_time), dest=0)
+
+
+def schedule(comm, jobs, costs, straggler_factor, poll_interval, mpi=None):
+    """ Rank-0 work queue (a generator of finished jobs).
+
+    `mpi` provides `Status` and `ANY_SOURCE` (mpi4py's `MPI` by default).
+    """
+    if mpi is None:
+        from mpi4py import MPI as mpi
+
+    pending = deque(range(len(jobs)))
+    running = {}  # rank -> (job, start time)
+    idle = deque()
+    finished = set()
+    n_workers = comm.Get_size() - 1
+    n_stopped = 0
+    cost_done, time_done = 0., 0.
+
+    def assign(rank):
+        if pending:
+            j = pending.popleft()
+        else:
+            # duplicate the slowest (relative to its expected time) straggler
+            if time_done == 0.:
+                return False
+
+            now = time.time()
+            copies = Counter(i for i, _ in running.values())
+            slowdown = {i: (now - start) * cost_done / (costs[i] * time_done)
+                        for i, start in running.values()
+                        if copies[i] == 1 and i not in finished}
+            stragglers = [i for i in slowdown if slowdown[i] > straggler_factor]
+            if not stragglers:
+                return False
+
+            j = max(stragglers, key=slowdown.get)
+            logger.warning("job %d is straggling (%.1fx), duplicating on rank %d",
+                           j, slowdown[j], rank)
+
+        running[rank] = (j, time.time())
+        comm.send(("job", j, jobs[j]), dest=rank)
+        return True
+
+    def stop(rank):
+        nonlocal n_stopped
+        comm.send(("stop", ), dest=rank)
+        n_stopped += 1
+
+    status = mpi.Status()
+    while n_stopped < n_workers:
+        if not comm.Iprobe(source=mpi.ANY_SOURCE, status=status):
+            # nothing to receive: see if idle ranks can help with stragglers
+            for _ in range(len(idle)):
+                rank = idle.popleft()
+                if len(finished) == len(jobs):
+                    stop(rank)
+                elif not assign(rank):
+                    idle.append(rank)
+
+            time.sleep(poll_interval)
+            continue
+
+        rank = status.Get_source()
+        msg = comm.recv(source=rank)
+        if msg[0] in ("done", "error", "cancelled"):
+            j, _ = running.pop(rank)
+            first = j not in finished
+            if msg[0] == "done":
+                finished.add(j)
+                _, _, out, elapsed = msg
+                if first:
+                    cost_done += costs[j]
+                    time_done += elapsed
+
+                    # the other copy (if any) is no longer needed
+                    for other, (i, _) in running.items():
+                        if i == j:
+                            comm.send(("cancel", j), dest=other)
+
+                yield j, rank, out, elapsed, first
+            elif msg[0] == "cancelled":
+                yield j, rank, None, msg[2], False
+            else:
+                # give up on it, unless a duplicate is still running
+                logger.error("job %d failed on rank %d: %s", j, rank, msg[2])
+                if all(i != j for i, _ in running.values()):
+                    finished.add(j)
+
+        if len(finished) == len(jobs):
+            stop(rank)
+        elif not assign(rank):
+            idle.append(rank)
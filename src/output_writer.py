@@ -0,0 +1,104 @@
+""" Streaming writes to HDF5 outputs, done on a background thread. """
+import logging
+import queue
+import threading
+
+import numpy as np
+
+# initialise the logger
+logger = logging.getLogger(__name__)
+
+
+class StreamingWriter:
+    """ Write rows to resizable, chunked and compressed HDF5 datasets.
+
+    Datasets are created up front (with their final `length`, if known) and
+    grown as rows are written, so outputs never need to be held in memory.
+    All HDF5 calls are made, in order, on the one background thread; the
+    file is flushed every `flush_every` writes so that partial outputs
+    survive the process dying. On `close`, datasets are padded (with zeros)
+    to their final lengths.
+    """
+    def __init__(self, output, chunk_rows=64, compression="gzip",
+                 flush_every=256, max_queue=1024):
+        self.output = output
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.flush_every = flush_every
+        self.lengths = {}
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def create(self, name, row_shape=(), length=None, dtype=np.float64):
+        """ Create `name` (re-using it if it exists, e.g. when resuming). """
+        self.lengths[name] = length
+        self.put(("create", name, tuple(row_shape), dtype))
+
+    def write(self, name, i, row):
+        """ Write `row` at index `i` of `name`, growing it as needed. """
+        self.put(("write", name, i, np.array(row, copy=True)))
+
+    def put(self, op):
+        if self.error is not None:
+            raise RuntimeError("Output writer failed") from self.error
+
+        self.queue.put(op)
+
+    def run(self):
+        n_writes = 0
+        while True:
+            op = self.queue.get()
+            try:
+                if op is None:
+                    break
+                elif op[0] == "create":
+                    self._create(*op[1:])
+                elif op[0] == "write":
+                    self._write(*op[1:])
+                    n_writes += 1
+                    if n_writes % self.flush_every == 0:
+                        self.output.flush()
+                elif op[0] == "flush":
+                    self.output.flush()
+            except Exception as e:
+                logger.error("output writer failed: %s", e)
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _create(self, name, row_shape, dtype):
+        if name in self.output:
+            return
+
+        self.output.create_dataset(name, shape=(0, ) + row_shape,
+                                   maxshape=(None, ) + row_shape,
+                                   chunks=(self.chunk_rows, ) + row_shape,
+                                   compression=self.compression, dtype=dtype)
+
+    def _write(self, name, i, row):
+        dataset = self.output[name]
+        if dataset.shape[0] <= i:
+            dataset.resize(i + 1, axis=0)
+
+        dataset[i] = row
+
+    def flush(self):
+        """ Block until all queued writes are on disk. """
+        self.put(("flush", ))
+        self.queue.join()
+
+    def close(self):
+        """ Finish writing, and pad all datasets to their final lengths. """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("Output writer failed") from self.error
+
+        for name, length in self.lengths.items():
+            if length is not None and self.output[name].shape[0] < length:
+                self.output[name].resize(length, axis=0)
+
+        self.output.flush()
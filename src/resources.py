@@ -0,0 +1,59 @@
+""" Splitting a core budget between pool workers and their BLAS threads. """
+import os
+
+# thread counts read by the BLAS/OpenMP runtimes (and so by numpy/scipy,
+# PETSc and MUMPS) when they are first loaded
+THREAD_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+               "BLIS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+
+def available_cores():
+    """ The cores this process may run on. """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def plan_layout(n_cores, n_jobs, n_threads=None):
+    """ Split `n_cores` into `(n_workers, n_threads)` for `n_jobs` jobs.
+
+    The linear algebra in each step is small (n_dofs x k), so extra
+    processes scale better than extra threads: workers get a single thread
+    unless there are fewer jobs than cores, in which case the spare cores
+    go to each worker's BLAS/solver threads. `n_threads` overrides this.
+    """
+    n_jobs = max(n_jobs, 1)
+    if n_threads is None:
+        n_threads = max(1, n_cores // n_jobs)
+
+    n_threads = max(1, min(n_threads, n_cores))
+    n_workers = max(1, min(n_jobs, n_cores // n_threads))
+    return n_workers, n_threads
+
+
+def core_sets(cores, n_workers, n_threads):
+    """ Disjoint sets of `n_threads` cores, one per worker. """
+    return [cores[i * n_threads:(i + 1) * n_threads] for i in range(n_workers)]
+
+
+def thread_env(n_threads):
+    """ Environment limiting the BLAS/OpenMP runtimes to `n_threads`. """
+    return {name: str(n_threads) for name in THREAD_VARS}
+
+
+def thread_count():
+    """ The BLAS/OpenMP thread count this process was started with.
+
+    Taken from the first of `THREAD_VARS` that is set, and otherwise the
+    runtimes' default (a thread per available core).
+    """
+    for name in THREAD_VARS:
+        if os.environ.get(name, "").isdigit():
+            return max(1, int(os.environ[name]))
+    return len(available_cores())
+
+
+def pin(cores):
+    """ Pin this process to `cores` (where supported). """
+    if hasattr(os, "sched_setaffinity") and len(cores) > 0:
+        os.sched_setaffinity(0, cores)
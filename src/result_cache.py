@@ -0,0 +1,104 @@
+""" Content-addressed store of finished filter outputs. """
+import glob
+import hashlib
+import logging
+import os
+import shutil
+
+import h5py
+
+# initialise the logger
+logger = logging.getLogger(__name__)
+
+
+def file_digest(path, block_size=1 << 20):
+    """ SHA-256 of the contents of `path`. """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def source_digest(src_dir=None):
+    """ SHA-256 over the (non-test) modules in `src_dir` (default: this one). """
+    if src_dir is None:
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+
+    h = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(src_dir, "*.py"))):
+        name = os.path.basename(path)
+        if name.startswith("test_"):
+            continue
+
+        h.update(name.encode())
+        h.update(file_digest(path).encode())
+
+    return h.hexdigest()
+
+
+def config_key(config):
+    """ SHA-256 of a (nested) dict of configuration values. """
+    def flatten(val):
+        if isinstance(val, dict):
+            return "{" + ",".join("{!r}:{}".format(k, flatten(val[k]))
+                                  for k in sorted(val)) + "}"
+        elif isinstance(val, (list, tuple)):
+            return "[" + ",".join(flatten(v) for v in val) + "]"
+        else:
+            return repr(val)
+
+    return hashlib.sha256(flatten(config).encode()).hexdigest()
+
+
+class ResultCache:
+    """ Finished outputs, stored under the hash of everything that made them.
+
+    Keys cover the full configuration, plus digests of the data file and of
+    the source, so that a change to any of these misses the cache rather
+    than silently re-using a stale output. Entries are copies (not links),
+    as outputs are later overwritten in place.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".h5")
+
+    def is_current(self, key, output_file):
+        """ Whether `output_file` is a finished output for `key`. """
+        try:
+            with h5py.File(output_file, "r") as f:
+                return (bool(f.attrs.get("complete", False))
+                        and f.attrs.get("config_key") == key)
+        except (OSError, KeyError):
+            return False
+
+    def fetch(self, key, output_file):
+        """ Copy the entry for `key` to `output_file`, returning whether it hit. """
+        if not os.path.exists(self.path(key)):
+            return False
+
+        self.copy(self.path(key), output_file)
+        logger.info("cache hit for %s (%s)", output_file, key[:12])
+        return True
+
+    def store(self, key, output_file):
+        """ Tag `output_file` with `key`, and add it to the cache (if finished). """
+        with h5py.File(output_file, "r+") as f:
+            if not f.attrs.get("complete", False) or f.attrs.get("failed", False):
+                return False
+
+            f.attrs.create("config_key", key)
+
+        self.copy(output_file, self.path(key))
+        return True
+
+    @staticmethod
+    def copy(src, dst):
+        """ Copy atomically, so that readers never see partial files. """
+        tmp = "{}.{}.tmp".format(dst, os.getpid())
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
@@ -1,3 +1,5 @@
+import os
+import glob
 import h5py
 import logging
 import time
@@ -7,10 +9,17 @@ import numpy as np
 import xarray as xr
 
 from itertools import product
-from multiprocessing import Pool
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
 from argparse import ArgumentParser
 from statfenics.utils import build_observation_operator
-from swe_filter import ShallowOneKalman, ShallowOneEx
+from swe_filter import ShallowOneKalman, ShallowOneEx, ShallowOneEnKF
+from swe_smoother import RTSSmoother
+from output_writer import StreamingWriter
+from mpi_sweep import mpi_sweep
+from resources import (available_cores, core_sets, pin, plan_layout, thread_count,
+                       thread_env)
+from result_cache import ResultCache, config_key, file_digest, source_digest
 
 # some setup fcns
 logging.basicConfig(level=logging.INFO)
@@ -46,56 +55,323 @@ def compute_errors(post, true, H_verts, relative=True):
         return v_norm_diff
 
 
-def run_model(data_file, nx_obs, nt_skip, k, s, nu, linear, output_dir,
-              posterior=True):
+def output_name(nx_obs, nt_skip, k, s, nu, linear, posterior, enkf=False):
+    """ Output file name (relative to the output directory). """
+    return "/{linearity}-{mtype}".format(
+        linearity="enkf" if enkf else ("linear" if linear else "nonlinear"),
+        mtype="posterior" if posterior else "prior"
+    ) + "-s-{s:.1f}-nx_obs-{nx_obs:d}-nt_skip-{nt_skip:d}-nu-{nu:.2e}-k-{k:d}.h5".format(
+        s=s,
+        nx_obs=nx_obs,
+        nt_skip=nt_skip,
+        nu=nu,
+        k=k)
+
+
+def is_complete(output_file):
+    """ Whether `output_file` exists, and is from a run that finished (without failing). """
+    try:
+        with h5py.File(output_file, "r") as f:
+            return bool(f.attrs.get("complete", False)) and not f.attrs.get("failed", False)
+    except (OSError, KeyError):
+        return False
+
+
+def estimate_cost(nt_skips, k, linear, enkf=False):
+    """ Rough (relative) cost of a run, for scheduling.
+
+    Covariance propagation scales with the number of columns pushed through
+    the LU: k, plus the effective rank of the process noise, which is taken
+    as its upper bound of k per field (so 3k). This overestimates runs where
+    a field's noise is dropped (e.g. `rho_u = 0`), but only the relative
+    costs matter. The nonlinear model needs a Jacobian assembly and
+    factorisation every step (the EnKF a Newton solve per member), and
+    updates (or LML evaluations) are cheap relative to prediction but add up
+    for small `nt_skip`, over each of the layouts sharing the run.
+    """
+    if enkf:
+        step = 4. * k
+    else:
+        step = (1. if linear else 4.) + 3 * k / 32
+    return step * (1. + np.sum(0.5 / np.atleast_1d(nt_skips)))
+
+
+def run_job(model_args):
+    """ Run a single configuration (for `imap_unordered`), timing it.
+
+    `model_args` are the keyword arguments of `run_layouts`.
+    """
+    start_time = time.time()
+    out = run_layouts(**model_args)
+    return model_args, out, time.time() - start_time
+
+
+def staging_dir(output_dir, rank):
+    """ Where MPI rank `rank` writes its outputs, before they are collected. """
+    return os.path.join(output_dir, ".staging", "rank-{:d}".format(rank), "")
+
+
+def run_staged(model_args, check_cancel=None):
+    """ MPI worker: run a configuration serially (on COMM_SELF), staged. """
+    from mpi4py import MPI
+
+    output_dir = staging_dir(model_args["output_dir"], MPI.COMM_WORLD.Get_rank())
+    os.makedirs(output_dir, exist_ok=True)
+    return run_layouts(**dict(model_args, output_dir=output_dir,
+                              check_cancel=check_cancel, comm=fe.MPI.comm_self))
+
+
+def collect_staged(model_args, rank, keep=True):
+    """ Move a finished job's outputs from `rank`'s staging directory.
+
+    Duplicates (of stragglers) that finished second, or were cancelled,
+    are deleted instead.
+    """
+    output_dir = model_args["output_dir"]
+    staged = staging_dir(output_dir, rank)
+    for nx_obs, nt_skip in model_args["layouts"]:
+        stem = output_name(nx_obs, nt_skip, model_args["k"], model_args["s"],
+                           model_args["nu"], model_args["linear"],
+                           model_args["posterior"], model_args["enkf"])
+        for path in glob.glob(staged + stem) + glob.glob(staged + stem[:-3] + "-*"):
+            if keep:
+                os.replace(path, output_dir + path[len(staged):])
+            else:
+                os.remove(path)
+
+
+def collect_results(model_args, results):
+    """ Collect the staged outputs of `mpi_sweep`, as `(model_args, out, elapsed)`. """
+    for j, rank, out, elapsed, first in results:
+        collect_staged(model_args[j], rank, keep=first)
+        if first:
+            yield model_args[j], out, elapsed
+
+
+def obs_indices(nx_obs):
+    """ Grid indices of the `nx_obs` observation locations. """
+    return np.linspace(50, 100, nx_obs, dtype="int")
+
+
+# observation data, shared across the pool workers, and the layout of the
+# pool (see `init_worker`)
+shared_data = None
+worker_layout = None
+
+
+def share_data(data_file, idx_obs_sets):
+    """ Load the data once into shared memory, for the pool workers.
+
+    Only the observed columns of `h` are read from disk, and each layout's
+    columns (one of `idx_obs_sets`) get their own contiguous block, so that
+    `load_data` can return them without copying. Returns the shared memory
+    blocks (to be unlinked by the caller), and a descriptor for the workers
+    to attach to them with.
+    """
+    idx_obs_sets = {tuple(int(c) for c in idx_obs): idx_obs for idx_obs in idx_obs_sets}
+    idx_cols = np.unique(np.concatenate(list(idx_obs_sets.values())))
+
+    dat = xr.open_dataset(data_file)
+    h = dat["h"][:, idx_cols].values
+    arrays = dict(t=dat.coords["t"].values,
+                  x=dat.coords["x"].values)
+    for key, idx_obs in idx_obs_sets.items():
+        arrays[key] = np.ascontiguousarray(h[:, np.searchsorted(idx_cols, idx_obs)])
+
+    desc = dict(shore_height=dat.attrs["shore_height"], arrays={})
+
+    blocks = []
+    for name, arr in arrays.items():
+        block = SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[:] = arr
+        desc["arrays"][name] = (block.name, arr.shape, arr.dtype.str)
+        blocks.append(block)
+
+    dat.close()
+    return blocks, desc
+
+
+def init_worker(desc, layout=None, core_queue=None):
+    """ Pool initialiser: attach (zero-copy, read-only) to the shared data.
+
+    Workers are also pinned to their own cores (taken from `core_queue`),
+    and the `layout` of the pool is kept to be recorded in the outputs.
+    """
+    global shared_data, worker_layout
+    shared_data = dict(desc, blocks=[], arrays={})
+    for name, (block_name, shape, dtype) in desc["arrays"].items():
+        block = SharedMemory(name=block_name)
+        arr = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        arr.flags.writeable = False
+        shared_data["blocks"].append(block)
+        shared_data["arrays"][name] = arr
+
+    if layout is not None:
+        cores = core_queue.get() if core_queue is not None else []
+        pin(cores)
+        worker_layout = dict(layout, cores=np.asarray(cores, dtype=np.int64))
+
+
+def load_data(data_file, idx_obs):
+    """ Times, grid, observed heights (columns `idx_obs`) and shore height. """
+    if shared_data is not None:
+        arrays = shared_data["arrays"]
+        h_obs = arrays[tuple(int(c) for c in idx_obs)]
+        return arrays["t"], arrays["x"], h_obs, shared_data["shore_height"]
+
+    dat = xr.open_dataset(data_file)
+    out = (dat.coords["t"].values, dat.coords["x"].values,
+           dat["h"][:, idx_obs].values, dat.attrs["shore_height"])
+    dat.close()
+    return out
+
+
+def save_checkpoint(checkpoint_file, swe, mean_checkpoint, cov_sqrt_checkpoint,
+                    counters):
+    """ Save the filter state and loop counters (atomically).
+
+    Partial outputs are already on disk, in the (streamed) output file.
+    """
+    tmp_file = checkpoint_file + ".tmp"
+    with h5py.File(tmp_file, "w") as f:
+        for name, val in swe.state_dict().items():
+            f.create_dataset("state/" + name, data=val)
+
+        f.create_dataset("mean_checkpoint", data=mean_checkpoint)
+        f.create_dataset("cov_sqrt_checkpoint", data=cov_sqrt_checkpoint)
+
+        # RNG state, so that (e.g.) EnKF runs resume exactly
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        f.create_dataset("rng_keys", data=keys)
+        f.attrs.update(rng_pos=pos, rng_has_gauss=has_gauss,
+                       rng_cached_gaussian=cached_gaussian)
+
+        for name, val in counters.items():
+            f.attrs.create(name, val)
+
+    os.replace(tmp_file, checkpoint_file)
+
+
+def load_checkpoint(checkpoint_file, swe):
+    """ Load a checkpoint into `swe`.
+
+    Returns the loop counters, and the last saved mean and covariance
+    square-root.
+    """
+    with h5py.File(checkpoint_file, "r") as f:
+        swe.load_state_dict({name: val[()] for name, val in f["state"].items()})
+        mean_checkpoint = f["mean_checkpoint"][()]
+        cov_sqrt_checkpoint = f["cov_sqrt_checkpoint"][()]
+        np.random.set_state(("MT19937", f["rng_keys"][()], int(f.attrs["rng_pos"]),
+                             int(f.attrs["rng_has_gauss"]),
+                             float(f.attrs["rng_cached_gaussian"])))
+        counters = {name: f.attrs[name] for name in
+                    ["i", "t", "i_save", "i_update", "t_checkpoint"]}
+
+    counters.update(i=int(counters["i"]), i_save=int(counters["i_save"]),
+                    i_update=int(counters["i_update"]))
+    return counters, mean_checkpoint, cov_sqrt_checkpoint
+
+
+def model_config(k, s, nu, lu_stale_tol=None, prefactored=False,
+                 reduction="step", k_max=None, var_target=None, k_min=None,
+                 matrix_free=False, cov_doubling=False, steady_state=None,
+                 basis_cache_dir=None, dtype="float64"):
+    """ Model control, statistical and physical parameters of a run. """
     # TODO(connor): eventually most of these will be args
+    model_control = control.copy()
+    if lu_stale_tol is not None:
+        model_control.update(lu_stale_tol=lu_stale_tol)
+    if prefactored:
+        model_control.update(prefactored=True)
+    if matrix_free:
+        model_control.update(matrix_free=True)
+
     stat_params = dict(rho_u=0., ell_u=1000.,
                        rho_h=2e-3, ell_h=1000.,
                        k=k, k_init_u=k, k_init_h=k,
-                       hilbert_gp=True)
+                       hilbert_gp=True, reduction=reduction,
+                       k_max=k_max,
+                       var_target=var_target,
+                       k_min=k_min,
+                       cov_doubling=cov_doubling,
+                       steady_state=steady_state is not None,
+                       basis_cache_dir=basis_cache_dir,
+                       dtype=dtype)
 
     params = dict(nu=nu, shore_start=s,
                   shore_height=5.,
                   bump_height=0., bump_centre=8000., bump_width=400)
 
-    # keep fixed for now
-    obs_system = dict(nt_skip=nt_skip, nx_obs=nx_obs, sigma_y=5e-2)
-
-    if linear:
-        swe = ShallowOneKalman(control=control,
+    return model_control, stat_params, params
+
+
+def result_key(nx_obs, nt_skip, k, s, nu, args, data_digest, src_digest):
+    """ Cache key of a run: its full configuration, the data and the source. """
+    model_control, stat_params, params = model_config(
+        k, s, nu, args.lu_stale_tol, args.prefactored, args.reduction,
+        args.k_max, args.var_target, args.k_min, args.matrix_free,
+        args.cov_doubling, args.steady_state, None, args.dtype)
+    return config_key(dict(control=model_control, stat_params=stat_params,
+                           params=params, nx_obs=nx_obs, nt_skip=nt_skip,
+                           linear=args.linear, posterior=args.posterior,
+                           enkf=args.enkf, steady_state=args.steady_state,
+                           smooth=args.smooth, data=data_digest, source=src_digest))
+
+
+def run_model(data_file, nx_obs, nt_skip, *args, **kwargs):
+    """ Run the filter for a single observation layout. """
+    return run_layouts(data_file, [(nx_obs, nt_skip)], *args, **kwargs)
+
+
+def run_layouts(data_file, layouts, k, s, nu, linear, output_dir,
+                posterior=True, lu_stale_tol=None, prefactored=False,
+                reduction="step", k_max=None, var_target=None, k_min=None,
+                enkf=False, matrix_free=False, cov_doubling=False,
+                steady_state=None, basis_cache_dir=None, dtype="float64",
+                smooth=False, checkpoint_interval=None, resume=False,
+                keep_history=False, t_final=12. * 60 * 60, check_cancel=None,
+                comm=None):
+    """ Run the filter, writing one output file per (nx_obs, nt_skip) layout.
+
+    Prior runs don't depend on the observations, so several layouts can
+    share the one propagation: each gets its own RMSEs and (predictive)
+    LMLs. Posterior runs take a single layout. The smoother's history file
+    is deleted after smoothing, unless `keep_history` is set. `check_cancel`
+    is called every step (see `mpi_sweep`), and `comm` is the model's
+    communicator (default: COMM_WORLD).
+    """
+    if len(layouts) > 1:
+        if posterior:
+            raise ValueError("Posterior runs take a single observation layout")
+        if reduction == "obs" or cov_doubling:
+            raise ValueError("Shared prior runs need layout-independent reductions")
+        if smooth or checkpoint_interval is not None or resume:
+            raise ValueError("Shared prior runs cannot be smoothed or checkpointed")
+
+    model_control, stat_params, params = model_config(
+        k, s, nu, lu_stale_tol, prefactored, reduction, k_max, var_target,
+        k_min, matrix_free, cov_doubling, steady_state, basis_cache_dir, dtype)
+
+    if enkf:
+        swe = ShallowOneEnKF(control=model_control,
+                             params=params,
+                             stat_params=stat_params,
+                             comm=comm)
+    elif linear:
+        swe = ShallowOneKalman(control=model_control,
                                params=params,
                                stat_params=stat_params,
-                               lr=True)
+                               lr=True, comm=comm)
     else:
-        swe = ShallowOneEx(control=control,
+        swe = ShallowOneEx(control=model_control,
                            params=params,
                            stat_params=stat_params,
-                           lr=True)
+                           lr=True, comm=comm)
 
     # set the simulation runtimes
-    t_final = 12. * 60 * 60.
     nt = np.int64(np.round(t_final / control["dt"]))
 
-    # first read in the data
-    dat = xr.open_dataset(data_file)
-    nt_obs = len([i for i in range(nt) if i % obs_system["nt_skip"] == 0])
-
-    # do some double checking
-    assert dat.attrs["shore_height"] == params["shore_height"]
-    assert control["dt"] == (dat.coords["t"].values[1]
-                             - dat.coords["t"].values[0])
-    assert t_final <= dat.coords["t"].values[-1]
-    np.testing.assert_allclose(dat.coords["x"].values, swe.x_coords.flatten())
-
-    # build observation/interpolation operators
-    idx_obs = np.linspace(50, 100, nx_obs, dtype="int")
-    x_obs = dat.coords["x"].values[idx_obs][:, np.newaxis]
-    y_obs = dat["h"].values[1:, idx_obs]  # dont include IC
-
-    # more double checking
-    assert (x_obs[0] >= 1000. and x_obs[-1] <= 2000.)
-
-    H_obs = build_observation_operator(x_obs, swe.W, sub=1, out="scipy")
     H_u_verts = build_observation_operator(swe.x_coords, swe.W, sub=0)
     H_h_verts = build_observation_operator(swe.x_coords, swe.W, sub=1)
 
@@ -103,147 +379,298 @@ def run_model(data_file, nx_obs, nt_skip, k, s, nu, linear, output_dir,
     thin = 10 * 60
     nt_save = len([i for i in range(nt) if i % thin == 0])
 
-    t_output = np.zeros((nt_save + 1, ))
-    u_mean_output = np.zeros((nt_save + 1, swe.n_vertices))
-    h_mean_output = np.zeros((nt_save + 1, swe.n_vertices))
-    u_var_output = np.zeros((nt_save + 1, swe.n_vertices))
-    h_var_output = np.zeros((nt_save + 1, swe.n_vertices))
-
     t_checkpoint = 0.
     mean_checkpoint = np.zeros((swe.n_dofs, ))
-    cov_sqrt_checkpoint = np.zeros((swe.n_dofs, swe.k))
-
-    # data-based outputs
-    t_obs = np.zeros((nt_obs, ))
-    rmse_output = np.zeros((nt_obs, ))
-    rmse_rel_output = np.zeros((nt_obs, ))
-
-    # posterior corrections
-    if posterior:
-        # save corrections (thinned across time)
-        # u_correction = np.zeros((nt_save, swe.n_vertices))
-        # h_correction = np.zeros((nt_save, swe.n_vertices))
-
-        # save log marginal likelihoods
-        lml_output = np.zeros((nt_obs, ))
-
-    # store outputs
-    t_output[0] = 0.
-    u_mean_output[0, :] = H_u_verts @ swe.du_prev.vector().get_local()
-    h_mean_output[0, :] = H_h_verts @ swe.du_prev.vector().get_local()
-    u_var_output[0, :] = np.sum((H_u_verts @ swe.cov_sqrt)**2, axis=1)
-    h_var_output[0, :] = np.sum((H_h_verts @ swe.cov_sqrt)**2, axis=1)
-
-    # TODO(connor): sort out some way of doing the pattern subs.
-    output_file_stem = "/{linearity}-{mtype}".format(
-        linearity="linear" if linear else "nonlinear",
-        mtype="posterior" if posterior else "prior"
-    ) + "-s-{s:.1f}-nx_obs-{nx_obs:d}-nt_skip-{nt_skip:d}-nu-{nu:.2e}-k-{k:d}.h5".format(
-        s=s,
-        nx_obs=nx_obs,
-        nt_skip=nt_skip,
-        nu=nu,
-        k=k)
-    output_file = output_dir + output_file_stem
-    output = h5py.File(output_file, "w")
-    logger.info("saving output to %s", output)
-
-    metadata = {**control, **stat_params, **obs_system}
-    for name, val in metadata.items():
-        output.attrs.create(name, val)
-
-    output.attrs.create("s", s)
-    output.attrs.create("nu", nu)
-    output.attrs.create("linear", linear)
-    output.attrs.create("posterior", posterior)
-
-    t = 0.
-    i_save = 0
-    i_update = 0
+    cov_sqrt_checkpoint = swe.cov_sqrt.copy()
+
+    obs = []
+    for nx_obs, nt_skip in layouts:
+        # keep fixed for now
+        obs_system = dict(nt_skip=nt_skip, nx_obs=nx_obs, sigma_y=5e-2)
+
+        # first read in the data (only the observed columns)
+        idx_obs = obs_indices(nx_obs)
+        t_data, x_data, h_obs, shore_height = load_data(data_file, idx_obs)
+        nt_obs = len([i for i in range(nt) if i % obs_system["nt_skip"] == 0])
+
+        # do some double checking
+        assert shore_height == params["shore_height"]
+        assert control["dt"] == (t_data[1] - t_data[0])
+        assert t_final <= t_data[-1]
+        np.testing.assert_allclose(x_data, swe.x_coords.flatten())
+
+        # build observation/interpolation operators
+        x_obs = x_data[idx_obs][:, np.newaxis]
+        y_obs = h_obs[1:, :]  # dont include IC
+
+        # more double checking
+        assert (x_obs[0] >= 1000. and x_obs[-1] <= 2000.)
+
+        H_obs = build_observation_operator(x_obs, swe.W, sub=1, out="scipy")
+
+        # TODO(connor): sort out some way of doing the pattern subs.
+        output_file_stem = output_name(nx_obs, nt_skip, k, s, nu, linear, posterior, enkf)
+        output_file = output_dir + output_file_stem
+
+        # resuming appends to the partial outputs already on disk
+        checkpoint_file = output_file.replace(".h5", "-checkpoint.h5")
+        resuming = resume and os.path.exists(checkpoint_file)
+        output = h5py.File(output_file, "r+" if resuming else "w")
+        logger.info("saving output to %s", output)
+
+        metadata = {**model_control, **stat_params, **obs_system}
+        for name, val in metadata.items():
+            if val is not None:
+                output.attrs.create(name, val)
+
+        # effective rank bounds (their defaults depend on the noise rank)
+        output.attrs.create("k_max", swe.k_max)
+        output.attrs.create("k_min", swe.k_min)
+
+        output.attrs.create("s", s)
+        output.attrs.create("nu", nu)
+        output.attrs.create("linear", linear)
+        output.attrs.create("enkf", enkf)
+        output.attrs.create("posterior", posterior)
+        output.attrs.create("smooth", smooth)
+        if worker_layout is not None:
+            for name, val in worker_layout.items():
+                output.attrs.create(name, val)
+
+        # outputs are streamed to disk as they are computed
+        writer = StreamingWriter(output)
+        for name in ["u_mean", "h_mean", "u_var", "h_var"]:
+            writer.create(name, (swe.n_vertices, ), length=nt_save + 1)
+
+        writer.create("t", length=nt_save + 1)
+        writer.create("t_obs", length=nt_obs)
+        writer.create("rmse", length=nt_obs)
+        writer.create("rmse_rel", length=nt_obs)
+
+        # rank of the covariance square-root, at each step
+        writer.create("rank", length=nt, dtype=np.int64)
+
+        # posterior corrections
+        if posterior:
+            # save corrections (thinned across time)
+            # writer.create("u_correction", (swe.n_vertices, ), length=nt_save)
+            # writer.create("h_correction", (swe.n_vertices, ), length=nt_save)
+            pass
+
+        # save log marginal likelihoods (predictive, for priors)
+        writer.create("lml", length=nt_obs)
+
+        obs.append(dict(obs_system=obs_system, t_data=t_data, y_obs=y_obs,
+                        H_obs=H_obs, stem=output_file_stem, output_file=output_file,
+                        checkpoint_file=checkpoint_file, output=output,
+                        writer=writer, i_update=0))
+
+    # checkpointing/smoothing are for a single layout
+    output_file_stem = obs[0]["stem"]
+    checkpoint_file = obs[0]["checkpoint_file"]
+    counters = dict(i=0, t=0., i_save=0, i_update=0, t_checkpoint=0.)
+    if resume and os.path.exists(checkpoint_file):
+        if smooth:
+            raise ValueError("Smoothed runs cannot be resumed")
+
+        counters, mean_checkpoint, cov_sqrt_checkpoint = load_checkpoint(
+            checkpoint_file, swe)
+        t_checkpoint = counters["t_checkpoint"]
+        obs[0]["i_update"] = counters["i_update"]
+        logger.info("%s resuming from step %d", output_file_stem, counters["i"])
+    else:
+        # store outputs
+        for o in obs:
+            o["writer"].write("t", 0, 0.)
+            o["writer"].write("u_mean", 0, H_u_verts @ swe.du_prev.vector().get_local())
+            o["writer"].write("h_mean", 0, H_h_verts @ swe.du_prev.vector().get_local())
+            o["writer"].write("u_var", 0, swe.marginal_var(H_u_verts))
+            o["writer"].write("h_var", 0, swe.marginal_var(H_h_verts))
+
+        # steady-state gain, computed before any data is seen
+        if steady_state == "offline" and posterior:
+            n_cycles = swe.precompute_steady_state(
+                obs[0]["H_obs"], obs[0]["obs_system"]["sigma_y"],
+                obs[0]["obs_system"]["nt_skip"])
+            logger.info("steady-state gain precomputed in %d cycles", n_cycles)
+
+    # stream the filter history for the smoother
+    if smooth:
+        smoother = RTSSmoother(
+            swe, obs[0]["output_file"].replace(".h5", "-history.h5"), nt,
+            keep=keep_history)
+        smoother.record_initial()
+
+    t = counters["t"]
+    failed = False
+    i_save = counters["i_save"]
+    i = counters["i"] - 1
     logger.info("%s starting running", output_file_stem)
-    for i in range(nt):
-        try:
-            # push model forward every timestep
-            t += swe.dt
-            swe.prediction_step(t)
-
-            # observe the data
-            if i % obs_system["nt_skip"] == 0:
-                y = y_obs[i, :]
-                np.testing.assert_approx_equal(
-                    t, dat.coords["t"].values[i + 1])
-
-                if posterior:
-                    # compute log-marginal likelihood and update
-                    lml_output[i_update] = swe.compute_lml(
-                        y, H_obs, obs_system["sigma_y"])
-
-                    correction = swe.update_step(
-                        y, H_obs, obs_system["sigma_y"],
-                        return_correction=True)
-
-                # compute RMSE
-                rmse_output[i_update] = compute_rmse(swe, y, H_obs, False)
-                rmse_rel_output[i_update] = compute_rmse(swe, y, H_obs, True)
-                t_obs[i_update] = t
-                i_update += 1
-
-            # set to previous
-            swe.set_prev()
-
-            # store outputs every thin'th iteration
-            if i % thin == 0:
-                t_output[i_save] = t
-
-                # u and h corrections
-                # u_correction[i_save] = H_u_verts @ correction
-                # h_correction[i_save] = H_h_verts @ correction
-
-                # means
-                u_mean_output[i_save, :] = H_u_verts @ swe.mean
-                h_mean_output[i_save, :] = H_h_verts @ swe.mean
-
-                # variances
-                u_var_output[i_save, :] = np.sum(
-                    (H_u_verts @ swe.cov_sqrt)**2, axis=1)
-                h_var_output[i_save, :] = np.sum(
-                    (H_h_verts @ swe.cov_sqrt)**2, axis=1)
-
-                # checkpointing
-                t_checkpoint = t
-                mean_checkpoint[:] = swe.mean.copy()
-                cov_sqrt_checkpoint[:] = swe.cov_sqrt.copy()
-                i_save += 1
-
-        except RuntimeError:
-            logger.error("Filter, nu = %.5f failed at t= %.5f, exiting", nu, t)
-            break
+    try:
+        for i in range(counters["i"], nt):
+            if check_cancel is not None:
+                check_cancel()
+
+            try:
+                # push model forward every timestep
+                t += swe.dt
+                swe.prediction_step(t)
+                if smooth:
+                    smoother.record_prediction(i)
+
+                # observe the data
+                for o in obs:
+                    obs_system, writer, i_update = o["obs_system"], o["writer"], o["i_update"]
+                    if i % obs_system["nt_skip"] != 0:
+                        continue
+
+                    y, H_obs = o["y_obs"][i, :], o["H_obs"]
+                    np.testing.assert_approx_equal(t, o["t_data"][i + 1])
+
+                    # deferred propagation and rank reduction
+                    swe.sync_cov_sqrt()
+                    if swe.reduction == "obs":
+                        swe.reduce_cov_sqrt()
+
+                    if posterior:
+                        # compute log-marginal likelihood and update
+                        lml, correction = swe.assimilate(
+                            y, H_obs, obs_system["sigma_y"])
+                        if smooth:
+                            smoother.record_update()
+                    else:
+                        lml = swe.compute_lml(y, H_obs, obs_system["sigma_y"])
+
+                    # compute RMSE
+                    writer.write("lml", i_update, lml)
+                    writer.write("rmse", i_update, compute_rmse(swe, y, H_obs, False))
+                    writer.write("rmse_rel", i_update, compute_rmse(swe, y, H_obs, True))
+                    writer.write("t_obs", i_update, t)
+                    o["i_update"] += 1
+
+                # set to previous
+                swe.set_prev()
+                for o in obs:
+                    o["writer"].write("rank", i, swe.cov_sqrt.shape[1])
+
+                # store outputs every thin'th iteration
+                if i % thin == 0:
+                    swe.sync_cov_sqrt()
+                    u_mean, h_mean = H_u_verts @ swe.mean, H_h_verts @ swe.mean
+                    u_var = swe.marginal_var(H_u_verts)
+                    h_var = swe.marginal_var(H_h_verts)
+                    for o in obs:
+                        writer = o["writer"]
+                        writer.write("t", i_save, t)
+
+                        # u and h corrections
+                        # writer.write("u_correction", i_save, H_u_verts @ correction)
+                        # writer.write("h_correction", i_save, H_h_verts @ correction)
+
+                        # means and variances
+                        writer.write("u_mean", i_save, u_mean)
+                        writer.write("h_mean", i_save, h_mean)
+                        writer.write("u_var", i_save, u_var)
+                        writer.write("h_var", i_save, h_var)
+
+                    # checkpointing
+                    t_checkpoint = t
+                    mean_checkpoint[:] = swe.mean.copy()
+                    cov_sqrt_checkpoint = swe.cov_sqrt.copy()
+                    i_save += 1
+
+                # save the full state, to resume from
+                if checkpoint_interval is not None and (i + 1) % checkpoint_interval == 0:
+                    obs[0]["writer"].flush()
+                    save_checkpoint(checkpoint_file, swe, mean_checkpoint, cov_sqrt_checkpoint,
+                                    dict(i=i + 1, t=t, i_save=i_save,
+                                         i_update=obs[0]["i_update"],
+                                         t_checkpoint=t_checkpoint))
+
+            except RuntimeError:
+                logger.error("Filter, nu = %.5f failed at t= %.5f, exiting", nu, t)
+                failed = True
+                break
+    except BaseException:
+        # interrupted: close the partial outputs (and keep the checkpoint),
+        # so that the run can be resumed. Errors in closing are only logged,
+        # so that it's the original exception that is raised
+        resources = [o[name] for o in obs for name in ["writer", "output"]]
+        if smooth:
+            resources.append(smoother)
+
+        for resource in resources:
+            try:
+                resource.close()
+            except Exception:
+                logger.exception("%s: failed to close %r", output_file_stem, resource)
+
+        raise
 
     # means and vars
     logger.info("%s finished running", output_file_stem)
-    output.create_dataset("t", data=t_output)
-    output.create_dataset("u_mean", data=u_mean_output)
-    output.create_dataset("u_var", data=u_var_output)
-    output.create_dataset("h_mean", data=h_mean_output)
-    output.create_dataset("h_var", data=h_var_output)
-
-    # checkpoints
-    output.create_dataset("t_checkpoint", data=t_checkpoint)
-    output.create_dataset("mean_checkpoint", data=mean_checkpoint)
-    output.create_dataset("cov_sqrt_checkpoint", data=cov_sqrt_checkpoint)
+    for o in obs:
+        output = o["output"]
+        o["writer"].close()
+        if swe.lr:
+            output.attrs.create("n_reductions", swe.n_reductions)
+            output.attrs.create("reduction_cost", swe.reduction_cost)
+
+        if isinstance(swe, ShallowOneEx):
+            logger.info("%s refactorised %d / %d Jacobians",
+                        o["stem"],
+                        swe.J_scipy_lu.n_factorizations,
+                        swe.J_scipy_lu.n_updates)
+            output.attrs.create("lu_factorizations", swe.J_scipy_lu.n_factorizations)
+            output.attrs.create("lu_updates", swe.J_scipy_lu.n_updates)
+            if swe.matrix_free:
+                output.attrs.create("mf_refreshes", swe.J_mf_solver.n_refreshes)
+        elif isinstance(swe, ShallowOneKalman):
+            output.attrs.create("gain_frozen", swe.frozen)
+
+        # checkpoints
+        for name, val in [("t_checkpoint", t_checkpoint),
+                          ("mean_checkpoint", mean_checkpoint),
+                          ("cov_sqrt_checkpoint", cov_sqrt_checkpoint)]:
+            if name in output:
+                del output[name]
+
+            output.create_dataset(name, data=val)
+
+    # backward pass: smoothed means/vars, at the same times as the filter's
+    if smooth and not failed:
+        logger.info("%s starting smoothing", output_file_stem)
+        u_mean_smooth = np.zeros((nt_save + 1, swe.n_vertices))
+        h_mean_smooth = np.zeros((nt_save + 1, swe.n_vertices))
+        u_var_smooth = np.zeros((nt_save + 1, swe.n_vertices))
+        h_var_smooth = np.zeros((nt_save + 1, swe.n_vertices))
+        for j, mean_smooth, cov_sqrt_smooth in smoother.backward():
+            if j >= 1 and (j - 1) % thin == 0:
+                j_save = (j - 1) // thin
+                u_mean_smooth[j_save, :] = H_u_verts @ mean_smooth
+                h_mean_smooth[j_save, :] = H_h_verts @ mean_smooth
+                u_var_smooth[j_save, :] = np.sum((H_u_verts @ cov_sqrt_smooth)**2, axis=1)
+                h_var_smooth[j_save, :] = np.sum((H_h_verts @ cov_sqrt_smooth)**2, axis=1)
+
+        output = obs[0]["output"]
+        output.create_dataset("u_mean_smooth", data=u_mean_smooth)
+        output.create_dataset("h_mean_smooth", data=h_mean_smooth)
+        output.create_dataset("u_var_smooth", data=u_var_smooth)
+        output.create_dataset("h_var_smooth", data=h_var_smooth)
+
+    if smooth:
+        smoother.close()
+
+    # mark as done, so that sweeps can skip this configuration
+    for o in obs:
+        o["output"].attrs.create("failed", failed)
+        o["output"].attrs.create("complete", True)
+        o["output"].close()
+
+    # finished runs start from scratch (rather than the end) if resumed
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
 
-    # outputs creation, etc
-    output.create_dataset("t_obs", data=t_obs)
-    output.create_dataset("rmse", data=rmse_output)
-    output.create_dataset("rmse_rel", data=rmse_rel_output)
-
-    if posterior:
-        output.create_dataset("lml", data=lml_output)
-
-        # output.create_dataset("u_correction", data=u_correction)
-        # output.create_dataset("h_correction", data=h_correction)
-
-    output.close()
     return i
 
 
@@ -253,25 +680,171 @@ if __name__ == "__main__":
 
     # read in from arguments
     parser = ArgumentParser()
-    parser.add_argument("--n_threads", type=int)
+    parser.add_argument("--n_threads", type=int)  # total core budget
+    parser.add_argument("--blas_threads", type=int, default=None)
+    parser.add_argument("--no_pin", action="store_true")
     parser.add_argument("--data_file", type=str)
     parser.add_argument("--posterior", action="store_true")
     parser.add_argument("--linear", action="store_true")
+    parser.add_argument("--enkf", action="store_true")
+    parser.add_argument("--matrix_free", action="store_true")
+    parser.add_argument("--cov_doubling", action="store_true")
+    parser.add_argument("--steady_state", type=str, default=None,
+                        choices=["online", "offline"])
     parser.add_argument("--nx_obs", nargs="+", type=int)  # default = 1
     parser.add_argument("--nt_skip", nargs="+", type=int)  # default = 30
     parser.add_argument("--nu", nargs="+", type=float)  # default = 1.
     parser.add_argument("--s", nargs="+", type=float)  # default = 1000.
     parser.add_argument("--k", nargs="+", type=int)  # default = 32
+    parser.add_argument("--lu_stale_tol", type=float, default=None)
+    parser.add_argument("--prefactored", action="store_true")
+    parser.add_argument("--reduction", type=str, default="step",
+                        choices=["step", "obs", "threshold"])
+    parser.add_argument("--k_max", type=int, default=None)
+    parser.add_argument("--k_min", type=int, default=None)
+    parser.add_argument("--var_target", type=float, default=None)
+    parser.add_argument("--basis_cache_dir", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default="float64",
+                        choices=["float64", "float32"])
+    parser.add_argument("--smooth", action="store_true")
+    parser.add_argument("--keep_history", action="store_true")
+    parser.add_argument("--checkpoint_interval", type=int, default=None)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--recompute", action="store_true")
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--mpi", action="store_true")
+    parser.add_argument("--straggler_factor", type=float, default=3.)
     parser.add_argument("--output_dir", type=str)
     args = parser.parse_args()
+    if args.reduction != "step" and args.k_max is None:
+        parser.error("--reduction {} needs --k_max".format(args.reduction))
+    if args.mpi and args.resume:
+        parser.error("--resume is not supported with --mpi (outputs are staged per rank)")
+    if args.mpi and (args.n_threads is not None or args.blas_threads is not None):
+        parser.error("--n_threads and --blas_threads are not supported with --mpi "
+                     "(the ranks' threads are set by the launcher)")
+
+    # with MPI, rank 0 schedules and the other ranks run the jobs
+    if args.mpi:
+        from mpi4py import MPI
+        is_root = MPI.COMM_WORLD.Get_rank() == 0
+
+        # each rank is a single worker: its BLAS has already been loaded, with
+        # the thread count of the launcher's environment (see the makefile),
+        # so that is recorded along with the cores the rank may run on
+        worker_layout = dict(n_workers=MPI.COMM_WORLD.Get_size() - 1,
+                             n_threads=thread_count(),
+                             cores=np.asarray(available_cores(), dtype=np.int64))
+    else:
+        is_root = True
+
+    # prior runs don't see the data, so each (k, s, nu) is run once for all
+    # of the observation layouts (each still gets its own output file)
+    share_priors = (not args.posterior and args.reduction != "obs"
+                    and not args.cov_doubling and not args.smooth
+                    and args.checkpoint_interval is None and not args.resume)
+    # finished outputs are looked up by the hash of their full configuration
+    if args.cache_dir is not None and is_root:
+        cache = ResultCache(args.cache_dir)
+        data_digest, src_digest = file_digest(args.data_file), source_digest()
+
+    runs, keys = {}, {}
+    for nx_obs, nt_skip, *a in product(args.nx_obs, args.nt_skip, args.k, args.s, args.nu):
+        if not is_root:
+            break
 
-    p = Pool(args.n_threads)
-    model_args = []
-    for a in product(args.nx_obs, args.nt_skip, args.k, args.s, args.nu):
-        model_args.append(
-            (args.data_file, *a, args.linear, args.output_dir, args.posterior))
-
-    out = p.starmap(run_model, model_args)
+        output_file = args.output_dir + output_name(
+            nx_obs, nt_skip, *a, args.linear, args.posterior, args.enkf)
+        if args.cache_dir is not None:
+            key = result_key(nx_obs, nt_skip, *a, args, data_digest, src_digest)
+            keys[output_file] = key
+            if not args.recompute and (cache.is_current(key, output_file)
+                                       or cache.fetch(key, output_file)):
+                logger.info("skipping %s, cached", output_file)
+                continue
+        elif not args.recompute and is_complete(output_file):
+            logger.info("skipping %s, already complete", output_file)
+            continue
+
+        key = tuple(a) if share_priors else (nx_obs, nt_skip, *a)
+        runs.setdefault(key, []).append((nx_obs, nt_skip))
+
+    model_args, costs = [], []
+    for key, layouts in runs.items():
+        k, s, nu = key[-3:]
+        model_args.append(dict(
+            data_file=args.data_file, layouts=layouts, k=k, s=s, nu=nu,
+            linear=args.linear, output_dir=args.output_dir, posterior=args.posterior,
+            lu_stale_tol=args.lu_stale_tol, prefactored=args.prefactored,
+            reduction=args.reduction, k_max=args.k_max, var_target=args.var_target,
+            k_min=args.k_min, enkf=args.enkf, matrix_free=args.matrix_free,
+            cov_doubling=args.cov_doubling, steady_state=args.steady_state,
+            basis_cache_dir=args.basis_cache_dir, dtype=args.dtype, smooth=args.smooth,
+            checkpoint_interval=args.checkpoint_interval, resume=args.resume,
+            keep_history=args.keep_history))
+        costs.append(estimate_cost([nt_skip for _, nt_skip in layouts], k,
+                                   args.linear, args.enkf))
+
+    # most expensive first, handed out one at a time as workers free up
+    order = np.argsort(costs)[::-1]
+    model_args = [model_args[j] for j in order]
+    costs = [costs[j] for j in order]
+
+    if args.mpi:
+        # workers read the data themselves (there's no shared memory across nodes)
+        results = mpi_sweep(model_args, costs, run_staged,
+                            straggler_factor=args.straggler_factor)
+        results = collect_results(model_args, results) if is_root else []
+    else:
+        # the observed columns, across all layouts, are read once and shared
+        blocks, desc = share_data(args.data_file, [obs_indices(n) for n in args.nx_obs])
+
+        # split the core budget between workers and their BLAS/solver
+        # threads; the thread counts are read when the (spawned) workers
+        # load their BLAS, and each worker is pinned to its own cores
+        cores = available_cores()
+        n_cores = min(args.n_threads or len(cores), len(cores))
+        n_workers, n_threads = plan_layout(n_cores, len(model_args), args.blas_threads)
+        layout = dict(n_workers=n_workers, n_threads=n_threads)
+        logger.info("running %d workers, with %d threads each", n_workers, n_threads)
+
+        ctx = get_context("spawn")
+        core_queue = ctx.Queue()
+        for worker_cores in core_sets(cores, n_workers, n_threads):
+            core_queue.put([] if args.no_pin else worker_cores)
+
+        env = os.environ.copy()
+        os.environ.update(thread_env(n_threads))
+        p = ctx.Pool(n_workers, initializer=init_worker,
+                     initargs=(desc, layout, core_queue))
+        os.environ.clear()
+        os.environ.update(env)
+
+        results = p.imap_unordered(run_job, model_args, chunksize=1)
+
+    cost_total, cost_done = sum(costs), 0.
+    sweep_start = time.time()
+    for n_done, (a, out, elapsed) in enumerate(results, start=1):
+        cost_done += costs[model_args.index(a)]
+        if args.cache_dir is not None:
+            for nx_obs, nt_skip in a["layouts"]:
+                output_file = args.output_dir + output_name(
+                    nx_obs, nt_skip, a["k"], a["s"], a["nu"], args.linear,
+                    args.posterior, args.enkf)
+                cache.store(keys[output_file], output_file)
+
+        sweep_elapsed = time.time() - sweep_start
+        eta = sweep_elapsed * (cost_total - cost_done) / cost_done
+        logger.info("%d / %d runs done (%.2f runs/min), last took %.1f s, ETA %.1f min",
+                    n_done, len(model_args), 60 * n_done / sweep_elapsed,
+                    elapsed, eta / 60)
+
+    if not args.mpi:
+        p.close()
+        p.join()
+        for block in blocks:
+            block.close()
+            block.unlink()
 
     # log wallclock time
     elapsed_time = time.time() - start_time
@@ -4,6 +4,9 @@ import logging
 import numpy as np
 import fenics as fe
 
+from scipy.sparse.linalg import splu
+from statfenics.utils import dolfin_to_csr
+
 # initialise the logger
 logger = logging.getLogger(__name__)
 
@@ -57,7 +60,7 @@ class PeriodicBoundary(fe.SubDomain):
 
 
 class ShallowOneLinear:
-    def __init__(self, control, params):
+    def __init__(self, control, params, comm=None):
         # read in parameters
         self.nx = control["nx"]
         self.dt = control["dt"]
@@ -72,8 +75,10 @@ class ShallowOneLinear:
         self.bump_centre = params["bump_centre"]
         self.L = 10_000
 
-        # setup mesh and function spaces
-        self.mesh = fe.IntervalMesh(self.nx, 0., self.L)
+        # setup mesh and function spaces (on `comm`: COMM_SELF for serial
+        # runs inside a parallel sweep)
+        self.comm = comm if comm is not None else fe.MPI.comm_world
+        self.mesh = fe.IntervalMesh(self.comm, self.nx, 0., self.L)
         self.x = fe.SpatialCoordinate(self.mesh)
 
         U = fe.FiniteElement("P", self.mesh.ufl_cell(), 2)
@@ -147,9 +152,41 @@ class ShallowOneLinear:
             self.a, self.l, self.du, bcs=self.bcs)
         self.solver = fe.LinearVariationalSolver(self.problem)
 
+        # LHS is time-invariant: optionally step with a single LU
+        self.prefactored = control.get("prefactored", False)
+        if self.prefactored:
+            self.setup_prefactored()
+
+    def setup_prefactored(self):
+        """ Assemble and factorise the system once, for direct time-stepping.
+
+        The RHS is `A_prev @ du_prev` (with BC rows set to identity), so each
+        step is a sparse matvec, a patch of the Dirichlet rows, and an LU solve.
+        """
+        self.A_mat = fe.assemble(self.a)
+        self.A_prev = fe.derivative(self.l, self.du_prev)
+        self.A_prev_mat = fe.assemble(self.A_prev)
+
+        for A in [self.A_mat, self.A_prev_mat]:
+            for bc in self.bcs:
+                bc.apply(A)
+
+        self.A_scipy = dolfin_to_csr(self.A_mat)
+        self.A_scipy_lu = splu(self.A_scipy.tocsc())
+        self.A_prev_scipy = dolfin_to_csr(self.A_prev_mat)
+
     def solve(self, t, set_prev=True):
         self.tidal_bc.t = t
-        self.solver.solve()
+        if self.prefactored:
+            b = self.A_prev_scipy @ self.du_prev.vector().get_local()
+            for bc in self.bcs:
+                bc_values = bc.get_boundary_values()
+                b[list(bc_values.keys())] = list(bc_values.values())
+
+            self.du.vector().set_local(self.A_scipy_lu.solve(b))
+        else:
+            self.solver.solve()
+
         if set_prev:
             fe.assign(self.du_prev, self.du)
 
@@ -187,7 +224,7 @@ class ShallowOneLinear:
 
 
 class ShallowOne:
-    def __init__(self, control, params):
+    def __init__(self, control, params, comm=None):
         self.nx = control["nx"]
         self.dt = control["dt"]
         self.simulation = control["simulation"]
@@ -212,8 +249,10 @@ class ShallowOne:
         # read in parameter values
         self.nu = params["nu"]
 
-        # setup mesh and function spaces
-        self.mesh = fe.IntervalMesh(self.nx, 0., self.L)
+        # setup mesh and function spaces (on `comm`: COMM_SELF for serial
+        # runs inside a parallel sweep)
+        self.comm = comm if comm is not None else fe.MPI.comm_world
+        self.mesh = fe.IntervalMesh(self.comm, self.nx, 0., self.L)
         self.x = fe.SpatialCoordinate(self.mesh)
         self.boundaries = fe.MeshFunction("size_t", self.mesh,
                                           self.mesh.topology().dim() - 1, 0)
@@ -326,7 +365,11 @@ class ShallowOne:
 
             self.bcs = fe.DirichletBC(self.W.sub(1), fe.Constant(0.), bounds)
 
-        problem = fe.NonlinearVariationalProblem(self.F, self.du, bcs=self.bcs, J=self.J)
+        self.setup_solver(self.F, self.J)
+
+    def setup_solver(self, F, J):
+        """ Set up the nonlinear solver for the residual `F`, with Jacobian `J`. """
+        problem = fe.NonlinearVariationalProblem(F, self.du, bcs=self.bcs, J=J)
         self.solver = fe.NonlinearVariationalSolver(problem)
 
         # vanilla fenics solver options
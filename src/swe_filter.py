@@ -1,11 +1,16 @@
 """ Solve the Shallow-water equations in non-conservative form. """
+import os
+import hashlib
 import logging
 
+from collections import deque
+
 import numpy as np
 import fenics as fe
 
+from scipy.sparse import csc_matrix, csr_matrix, issparse, load_npz, save_npz
 from scipy.sparse.linalg import splu, eigs
-from scipy.linalg import cholesky, cho_factor, cho_solve, eigh
+from scipy.linalg import cholesky, cho_factor, cho_solve, eigh, solve_triangular
 
 from statfenics.covariance import (sq_exp_covariance,
                                    sq_exp_evd_hilbert,
@@ -17,173 +22,877 @@ from swe import ShallowOne, ShallowOneLinear
 logger = logging.getLogger(__name__)
 
 
-class ShallowOneFilter:
-    def __init__(self, stat_params, lr=False):
-        u, v = fe.TrialFunction(self.U_space), fe.TestFunction(self.U_space)
-        M_u = fe.assemble(fe.inner(u, v) * fe.dx)
-        M_u_scipy = dolfin_to_csr(M_u)
+# block sizes for upcasting reduced-precision factors to float64
+UPCAST_BLOCK_ROWS = 512
+SOLVE_BLOCK_COLS = 16
+
+
+def csr_row_mask(A, rows):
+    """ Mask of the CSR data entries in `rows`, and the indices of their diagonals. """
+    row_idx = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+    mask = np.isin(row_idx, rows)
+    diag = np.flatnonzero(mask & (A.indices == row_idx))
+    assert len(diag) == len(rows), "BC rows must have diagonal entries"
+    return mask, diag
+
+
+def cache_key(**kwargs):
+    """ Content hash of `kwargs` (arrays are hashed by their bytes). """
+    h = hashlib.sha256()
+    for name in sorted(kwargs):
+        val = kwargs[name]
+        h.update(name.encode())
+        if isinstance(val, np.ndarray):
+            h.update(np.ascontiguousarray(val).tobytes())
+        else:
+            h.update(repr(val).encode())
+
+    return h.hexdigest()
+
+
+def compress_sqrt(X, k):
+    """ Best rank-`k` square-root of `X @ X.T`, as `X @ V_k` (leading eigvecs of `X.T @ X`). """
+    D, V = eigh(X.T @ X)
+    return X @ V[:, ::-1][:, :k]
+
+
+class BlockNoise:
+    """ Low-rank process-noise factor, stored as per-field blocks.
+
+    Each block is a (dofs, factor) pair, with the factor supported only on
+    the `dofs` rows of the full factor. Empty blocks (e.g. when `rho_u = 0`)
+    are dropped, so that `rank` is the effective rank of the process noise.
+    """
+    def __init__(self, n_dofs, blocks):
+        self.n_dofs = n_dofs
+        self.blocks = [(np.asarray(dofs), factor) for dofs, factor in blocks
+                       if factor.shape[1] > 0]
+        self.rank = sum(factor.shape[1] for _, factor in self.blocks)
+
+    @property
+    def shape(self):
+        return (self.n_dofs, self.rank)
+
+    def fill(self, out, scale=1.):
+        """ Write `scale * G_sqrt` into the dense (n_dofs x rank) `out`. """
+        out[:] = 0.
+        j = 0
+        for dofs, factor in self.blocks:
+            out[dofs, j:(j + factor.shape[1])] = scale * factor
+            j += factor.shape[1]
+
+    def toarray(self):
+        out = np.zeros(self.shape)
+        self.fill(out)
+        return out
+
+    def __matmul__(self, z):
+        out = np.zeros((self.n_dofs, ) + z.shape[1:])
+        j = 0
+        for dofs, factor in self.blocks:
+            out[dofs] += factor @ z[j:(j + factor.shape[1])]
+            j += factor.shape[1]
+
+        return out
+
+
+class ReusableLU:
+    """ Sparse LU for a sequence of matrices with a fixed sparsity pattern.
+
+    The fill-reducing column ordering is computed once, by the first
+    factorisation (which is kept), and later factorisations are done on the
+    pre-permuted matrix, whose entries are gathered into a fixed CSC
+    structure. Only the column ordering is re-used: SuperLU still redoes
+    the symbolic analysis on each factorisation.
+
+    If `stale_tol` is set then an out-of-date factorisation is re-used as a
+    preconditioner for up to `max_iter` refinement iterations, and the
+    matrix is only refactorised when the relative residual is still above
+    `stale_tol`.
+    """
+    def __init__(self, permc_spec="COLAMD", stale_tol=None, max_iter=3):
+        self.permc_spec = permc_spec
+        self.stale_tol = stale_tol
+        self.max_iter = max_iter
+
+        self.A = None
+        self.lu = None
+        self.perm = None
+        self.permuted = False
+        self.stale = True
+
+        # reporting
+        self.n_updates = 0
+        self.n_factorizations = 0
+
+    def update(self, A):
+        """ Set the current matrix to `A`, refactorising unless stale LUs are allowed. """
+        self.A = A
+        self.stale = True
+        self.n_updates += 1
+
+        if self.lu is None or self.stale_tol is None:
+            self.factorize()
+
+    def factorize(self):
+        A = self.A.tocsc()
+        if self.perm is None:
+            self.lu = splu(A, permc_spec=self.permc_spec)
+            self.perm = np.argsort(self.lu.perm_c)
+
+            # positions of A's entries in A[:, perm], to permute later matrices
+            index = csc_matrix((np.arange(A.nnz, dtype=np.float64), A.indices, A.indptr),
+                               shape=A.shape)
+            self.A_perm = index[:, self.perm]
+            self.data_perm = self.A_perm.data.astype(np.int64)
+        else:
+            np.take(A.data, self.data_perm, out=self.A_perm.data)
+            self.lu = splu(self.A_perm, permc_spec="NATURAL")
+            self.permuted = True
+
+        self.stale = False
+        self.n_factorizations += 1
+
+    def _solve(self, b):
+        if not self.permuted:
+            return self.lu.solve(b)
+
+        x = np.empty_like(b, dtype=np.float64)
+        x[self.perm] = self.lu.solve(b)
+        return x
+
+    def solve(self, b):
+        x = self._solve(b)
+        if not self.stale:
+            return x
 
-        u, v = fe.TrialFunction(self.H_space), fe.TestFunction(self.H_space)
-        M_h = fe.assemble(fe.inner(u, v) * fe.dx)
-        M_h_scipy = dolfin_to_csr(M_h)
+        # iterative refinement, preconditioned by the stale LU
+        b_norm = np.linalg.norm(b)
+        for i in range(self.max_iter):
+            r = b - self.A @ x
+            if np.linalg.norm(r) <= self.stale_tol * b_norm:
+                return x
+            x += self._solve(r)
 
-        u, v = fe.TrialFunction(self.W), fe.TestFunction(self.W)
-        M = fe.assemble(fe.inner(u, v) * fe.dx)
-        M_scipy = dolfin_to_csr(M)
+        if np.linalg.norm(b - self.A @ x) <= self.stale_tol * b_norm:
+            return x
 
+        logger.debug("Stale LU drifted past tolerance, refactorising")
+        self.factorize()
+        return self._solve(b)
+
+    @property
+    def refactorization_rate(self):
+        """ Proportion of matrix updates that needed a new factorisation. """
+        return self.n_factorizations / max(self.n_updates, 1)
+
+
+class FormAction:
+    """ Matrix-free action of the bilinear form `a`, with identity BC rows.
+
+    `A @ X` assembles the action of `a` on each column of `X`, so that `a`
+    itself is never assembled. dolfin has no multi-vector action, so this
+    is one (vector) assembly per column.
+    """
+    def __init__(self, a, W, bc_dofs):
+        self.w = fe.Function(W)
+        self.action = fe.action(a, self.w)
+        self.action_vec = fe.assemble(self.action)
+        self.bc_dofs = bc_dofs
+
+    def __matmul__(self, X):
+        Y = np.zeros_like(X, dtype=np.float64)
+        for i in range(X.shape[1]):
+            self.w.vector().set_local(X[:, i])
+            fe.assemble(self.action, tensor=self.action_vec)
+            Y[:, i] = self.action_vec.get_local()
+
+        Y[self.bc_dofs, :] = X[self.bc_dofs, :]
+        return Y
+
+
+class MatrixFreeSolver:
+    """ Solve with a matrix-free operator, preconditioned by a re-used LU.
+
+    Iterates `X <- X + P^{-1} (B - A @ X)`, with `P` an LU of the assembled
+    operator from an earlier step. If the relative residual is not below
+    `tol` in `max_iter` iterations, `assemble` is called to refresh `P`.
+    """
+    def __init__(self, A, assemble, tol=1e-10, max_iter=5):
+        self.A = A
+        self.assemble = assemble
+        self.tol = tol
+        self.max_iter = max_iter
+
+        self.pc = ReusableLU()
+        self.n_refreshes = 0
+
+    def refresh(self):
+        # only the factors are kept, not the assembled operator
+        self.pc.update(self.assemble())
+        self.pc.A = None
+        self.n_refreshes += 1
+
+    def solve(self, B):
+        if self.pc.lu is None:
+            self.refresh()
+            return self.pc.solve(B)
+
+        X = self.pc.solve(B)
+        B_norm = np.linalg.norm(B)
+        for i in range(self.max_iter):
+            R = B - self.A @ X
+            if np.linalg.norm(R) <= self.tol * B_norm:
+                return X
+            X += self.pc.solve(R)
+
+        if np.linalg.norm(B - self.A @ X) <= self.tol * B_norm:
+            return X
+
+        logger.debug("Matrix-free solve not converged, refreshing preconditioner")
+        self.refresh()
+        return self.pc.solve(B)
+
+
+class ShallowOneFilter:
+    def __init__(self, stat_params, lr=False):
         self.lr = lr
         self.mean = self.du.vector().get_local()
 
+        # on-disk cache for the mass matrices and process-noise factors
+        self.cache_dir = stat_params.get("basis_cache_dir", None)
+
+        # form of the update: "batch", "woodbury" or "serial" (low-rank only),
+        # or "auto"
+        self.update_form = stat_params.get("update_form", "auto")
+        if self.update_form not in ["auto", "batch", "woodbury", "serial"]:
+            raise ValueError(f"Update form {self.update_form} not recognised")
+        if self.update_form in ["woodbury", "serial"] and not self.lr:
+            raise ValueError(f"{self.update_form} updates require a low-rank filter")
+
         if self.lr:
             self.k_init_u = stat_params["k_init_u"]
             self.k_init_h = stat_params["k_init_h"]
             self.k = stat_params["k"]
 
-            # matrix inits
-            self.cov_sqrt = np.zeros((self.mean.shape[0], self.k))
-            self.cov_sqrt_prev = np.zeros((self.mean.shape[0], self.k))
-            self.cov_sqrt_pred = np.zeros((self.mean.shape[0],
-                                           self.k + self.k_init_u + self.k_init_h))
-            self.G_sqrt = np.zeros((self.mean.shape[0],
-                                    self.k_init_u + self.k_init_h))
-
-            if stat_params["rho_u"] > 0.:
-                if stat_params["hilbert_gp"]:
-                    Ku_vals, Ku_vecs = sq_exp_evd_hilbert(
-                        self.U_space, self.k_init_u,
-                        stat_params["rho_u"],
-                        stat_params["ell_u"])
-                else:
-                    Ku_vals, Ku_vecs = sq_exp_evd(self.x_dofs_u,
-                                                  stat_params["rho_u"],
-                                                  stat_params["ell_u"],
-                                                  k=self.k_init_u)
+            # storage precision of the factors: Gram matrices, Cholesky
+            # factors and the LML are always accumulated in float64
+            self.dtype = np.dtype(stat_params.get("dtype", "float64"))
 
-                self.G_sqrt[self.u_dofs, 0:len(Ku_vals)] = (
-                    Ku_vecs @ np.diag(np.sqrt(Ku_vals)))
-                print(f"Spectral diff (u): {Ku_vals[-1]:.4e}, {Ku_vals[0]:.4e}")
+            # process noise, with `k_noise` its effective rank
+            self.noise = self.build_noise(stat_params)
+            self.k_noise = self.noise.rank
 
-            if stat_params["rho_h"] > 0.:
-                if stat_params["hilbert_gp"]:
-                    Kh_vals, Kh_vecs = sq_exp_evd_hilbert(
-                        self.H_space, self.k_init_h,
-                        stat_params["rho_h"],
-                        stat_params["ell_h"])
-                else:
-                    Kh_vals, Kh_vecs = sq_exp_evd(self.x_dofs_h,
-                                                  stat_params["rho_h"],
-                                                  stat_params["ell_h"],
-                                                  k=self.k_init_h)
-                self.G_sqrt[self.h_dofs, self.k_init_u:(self.k_init_u + len(Kh_vals))] = (
-                    Kh_vecs @ np.diag(np.sqrt(Kh_vals)))
-                print(f"Spectral diff (h): {Kh_vals[-1]:.4e}, {Kh_vals[0]:.4e}")
-
-            # multiplication *after* the initial construction
-            self.G_sqrt[:] = M_scipy @ self.G_sqrt
+            # rank reduction is done every step ("step"), at observation times
+            # ("obs"), or when the rank exceeds `k_max` ("threshold"); the
+            # rank is always kept below `k_max`
+            self.reduction = stat_params.get("reduction", "step")
+            if self.reduction not in ["step", "obs", "threshold"]:
+                raise ValueError(f"Reduction {self.reduction} not recognised")
+
+            # adaptive rank: keep the smallest rank in [k_min, k_max] that
+            # retains `var_target` of the variance (k is the initial rank)
+            self.var_target = stat_params.get("var_target", None)
+
+            # deferring pays off only while one reduction of the grown factor
+            # (a Gram matrix of up to k_max + k_noise columns) costs less than
+            # the per-step reductions (of k + k_noise columns) it replaces, and
+            # the solves also carry the extra columns: e.g. with k_noise small
+            # next to k. As this depends on the run, deferred reductions need
+            # an explicit `k_max`. Adaptive ranks can by default grow by the
+            # noise added in a step
+            n_dofs = self.mean.shape[0]
+            self.k_max = stat_params.get("k_max", None)
+            if self.k_max is None and self.reduction != "step":
+                raise ValueError(f"{self.reduction} reductions need an explicit k_max")
+            elif self.k_max is None and self.var_target is not None:
+                self.k_max = min(n_dofs, self.k + self.k_noise)
+            elif self.k_max is None:
+                self.k_max = self.k
+
+            if self.reduction != "step" and self.k_max < min(n_dofs, self.k + self.k_noise):
+                raise ValueError(f"{self.reduction} reductions need k_max >= k + k_noise "
+                                 f"({self.k + self.k_noise}), else they happen every step")
+
+            self.k_min = stat_params.get("k_min", None)
+            if self.k_min is None:
+                self.k_min = 1 if self.var_target is not None else self.k
+
+            if self.var_target is not None and self.k_min == self.k_max:
+                raise ValueError("Adaptive rank needs k_min < k_max")
+            assert self.k_min <= self.k <= self.k_max
+
+            # sparse operators cast to the storage precision (see `cast_operator`)
+            self.A_cast = None
+
+            # reporting: number of reductions, and their total cost (the sum
+            # of the squared widths of the reduced factors)
+            self.n_reductions = 0
+            self.reduction_cost = 0
+
+            # preallocated workspaces: factors are contiguous views into these
+            self.cov_sqrt_buf = np.zeros((n_dofs * self.k_max, ), dtype=self.dtype)
+            self.cov_sqrt_prev_buf = np.zeros((n_dofs * self.k_max, ), dtype=self.dtype)
+            self.cov_sqrt_pred_buf = np.zeros((n_dofs * (self.k_max + self.k_noise), ),
+                                              dtype=self.dtype)
+            self.gram_buf = np.zeros(((self.k_max + self.k_noise)**2, ))
+
+            # matrix inits
+            self.cov_sqrt = self.buffer_view(self.cov_sqrt_buf, self.k)
+            self.cov_sqrt_prev = self.buffer_view(self.cov_sqrt_prev_buf, self.k)
+            self.cov_sqrt_pred = self.buffer_view(self.cov_sqrt_pred_buf,
+                                                  self.k + self.k_noise)
         else:
-            K_u = sq_exp_covariance(self.x_dofs_u,
-                                    stat_params["rho_u"],
-                                    stat_params["ell_u"])
-            K_h = sq_exp_covariance(self.x_dofs_h,
-                                    stat_params["rho_h"],
-                                    stat_params["ell_h"])
-
-            self.G = np.zeros((self.mean.shape[0], self.mean.shape[0]))
-            self.G[np.ix_(self.u_dofs, self.u_dofs)] = M_u_scipy @ K_u @ M_u_scipy.T
-            self.G[np.ix_(self.h_dofs, self.h_dofs)] = M_h_scipy @ K_h @ M_h_scipy.T
-            self.G[np.diag_indices_from(self.G)] += 1e-10
+            noise_key = dict(**self.discretisation_key(),
+                             **{name: stat_params[name] for name in
+                                ["rho_u", "ell_u", "rho_h", "ell_h"]})
+            self.G = self.cached("G", noise_key, lambda: self.build_G(stat_params))
 
             # normal covariance structure
             self.cov = np.zeros((self.mean.shape[0], self.mean.shape[0]))
             self.cov_prev = np.zeros((self.mean.shape[0], self.mean.shape[0]))
             self.cov_pred = np.zeros((self.mean.shape[0], self.mean.shape[0]))
 
+    def discretisation_key(self):
+        """ Everything that the mass matrices depend on, for the cache key. """
+        return dict(dolfin=fe.__version__,
+                    element=str(self.W.ufl_element()),
+                    x_dofs=self.W.tabulate_dof_coordinates(),
+                    u_dofs=np.asarray(self.u_dofs),
+                    h_dofs=np.asarray(self.h_dofs))
+
+    def cached(self, name, key, build):
+        """ Load `name` from the on-disk cache, else `build()` and store it.
+
+        Entries are content-addressed (by the hash of `key`), dense arrays are
+        stored as `.npy` and memory-mapped (read-only) on loading, and sparse
+        matrices as `.npz`. Writes are atomic, so concurrent runs can share
+        the one cache directory.
+        """
+        if self.cache_dir is None:
+            return build()
+
+        stem = os.path.join(self.cache_dir, f"{name}-{cache_key(**key)}")
+        if os.path.exists(stem + ".npy"):
+            return np.load(stem + ".npy", mmap_mode="r")
+        elif os.path.exists(stem + ".npz"):
+            return load_npz(stem + ".npz").tocsr()
+
+        val = build()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f"{stem}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            if issparse(val):
+                save_npz(f, val)
+            else:
+                np.save(f, val)
+
+        os.replace(tmp, stem + (".npz" if issparse(val) else ".npy"))
+        logger.info("cached %s to %s", name, stem)
+        return self.cached(name, key, build)
+
+    def mass_matrix(self, name):
+        """ Mass matrix on the "u", "h" or mixed ("w") space, as scipy CSR. """
+        space = dict(u=self.U_space, h=self.H_space, w=self.W)[name]
+
+        def build():
+            u, v = fe.TrialFunction(space), fe.TestFunction(space)
+            return dolfin_to_csr(fe.assemble(fe.inner(u, v) * fe.dx))
+
+        return self.cached(f"M_{name}", self.discretisation_key(), build)
+
+    @property
+    def G_sqrt(self):
+        """ Dense square-root of the process-noise covariance. """
+        return self.noise.toarray()
+
+    def build_noise(self, stat_params):
+        """ Process-noise factor `M @ [K_u^{1/2}, K_h^{1/2}]`, as a `BlockNoise`.
+
+        The mass matrix is block-diagonal across the fields, so each block
+        is `M[dofs, dofs] @ K^{1/2}`; zero-variance fields are skipped. Blocks
+        are cached separately, so a field's block is re-used while only the
+        other field's hyperparameters change.
+        """
+        M = self.mass_matrix("w")
+        blocks = []
+        for name, space, dofs, x_dofs, k_init in [
+                ("u", self.U_space, self.u_dofs, self.x_dofs_u, self.k_init_u),
+                ("h", self.H_space, self.h_dofs, self.x_dofs_h, self.k_init_h)]:
+            rho, ell = stat_params[f"rho_{name}"], stat_params[f"ell_{name}"]
+            if rho <= 0. or k_init == 0:
+                continue
+
+            def build():
+                if stat_params["hilbert_gp"]:
+                    K_vals, K_vecs = sq_exp_evd_hilbert(space, k_init, rho, ell)
+                else:
+                    K_vals, K_vecs = sq_exp_evd(x_dofs, rho, ell, k=k_init)
+
+                print(f"Spectral diff ({name}): {K_vals[-1]:.4e}, {K_vals[0]:.4e}")
+                return M[dofs][:, dofs] @ (K_vecs @ np.diag(np.sqrt(K_vals)))
+
+            block_key = dict(**self.discretisation_key(), field=name,
+                             rho=rho, ell=ell, k_init=k_init,
+                             hilbert_gp=stat_params["hilbert_gp"])
+            factor = self.cached(f"G_sqrt_{name}", block_key, build)
+            blocks.append((dofs, factor.astype(self.dtype, copy=False)))
+
+        return BlockNoise(self.mean.shape[0], blocks)
+
+    def build_G(self, stat_params):
+        """ Process-noise covariance, `M K M^T` (block-diagonal in u, h). """
+        M_u_scipy, M_h_scipy = self.mass_matrix("u"), self.mass_matrix("h")
+        K_u = sq_exp_covariance(self.x_dofs_u,
+                                stat_params["rho_u"],
+                                stat_params["ell_u"])
+        K_h = sq_exp_covariance(self.x_dofs_h,
+                                stat_params["rho_h"],
+                                stat_params["ell_h"])
+
+        G = np.zeros((self.mean.shape[0], self.mean.shape[0]))
+        G[np.ix_(self.u_dofs, self.u_dofs)] = M_u_scipy @ K_u @ M_u_scipy.T
+        G[np.ix_(self.h_dofs, self.h_dofs)] = M_h_scipy @ K_h @ M_h_scipy.T
+        G[np.diag_indices_from(G)] += 1e-10
+        return G
+
     def prediction_step(self, t):
         raise NotImplementedError
 
-    def compute_lml(self, y, H, sigma_y):
-        self.mean[:] = self.du.vector().get_local()
-        mean_obs = H @ self.mean
-        n_obs = len(mean_obs)
+    def sync_cov_sqrt(self):
+        """ Bring `cov_sqrt` up to date, if its propagation has been deferred. """
+        pass
 
-        if self.lr:
-            HL = H @ self.cov_sqrt
-            cov_obs = HL @ HL.T
+    def buffer_view(self, buf, n_cols):
+        """ View the first `n_cols` columns' worth of `buf` as a C-ordered matrix. """
+        return buf[:(self.mean.shape[0] * n_cols)].reshape((-1, n_cols))
+
+    def predict_cov_sqrt(self, A_prev, A_lu):
+        """ Push the covariance square-root forward, reducing as required.
+
+        The predicted factor is `A^{-1} [A_prev @ cov_sqrt_prev, dt * G_sqrt]`.
+        """
+        k_prev = self.cov_sqrt_prev.shape[1]
+        self.k_prev = k_prev
+        self.cov_sqrt_pred = self.buffer_view(self.cov_sqrt_pred_buf,
+                                              k_prev + self.k_noise)
+        if issparse(A_prev):
+            # cast the (small) sparse operator, rather than the factor
+            self.cov_sqrt_pred[:, :k_prev] = self.cast_operator(A_prev) @ self.cov_sqrt_prev
+        else:
+            self.left_multiply(A_prev, self.cov_sqrt_prev, out=self.cov_sqrt_pred[:, :k_prev])
+        self.noise.fill(self.cov_sqrt_pred[:, k_prev:], self.dt)
+        self.solve_in_place(A_lu, self.cov_sqrt_pred)
+
+        if self.reduction == "step" or self.cov_sqrt_pred.shape[1] > self.k_max:
+            self.reduce_cov_sqrt(self.cov_sqrt_pred)
         else:
-            HC = H @ self.cov
-            cov_obs = H @ self.cov @ H.T
+            self.cov_sqrt = self.buffer_view(self.cov_sqrt_buf,
+                                             self.cov_sqrt_pred.shape[1])
+            self.cov_sqrt[:] = self.cov_sqrt_pred
 
-        cov_obs[np.diag_indices_from(cov_obs)] += sigma_y**2 + 1e-10
-        S_chol = cho_factor(cov_obs, lower=True)
-        S_inv_y = cho_solve(S_chol, y - mean_obs)
-        log_det = 2 * np.sum(np.log(np.diag(S_chol[0])))
+    def cast_operator(self, A):
+        """ Sparse `A` in the storage precision of the factors.
 
-        return (- S_inv_y @ S_inv_y / 2
-                - log_det / 2
-                - n_obs * np.log(2 * np.pi) / 2)
+        The cast copy is made once, and only its entries are refreshed on
+        later calls (operators keep their sparsity pattern between steps).
+        """
+        if A.dtype == self.dtype:
+            return A
 
-    def update_step(self, y, H, sigma_y, return_correction=False):
+        if self.A_cast is None or self.A_cast[0] is not A:
+            self.A_cast = (A, A.astype(self.dtype))
+        else:
+            self.A_cast[1].data[:] = A.data
+
+        return self.A_cast[1]
+
+    def solve_in_place(self, A_lu, X):
+        """ Overwrite `X` with `A^{-1} X`.
+
+        Solves are in float64: reduced-precision factors are solved a block
+        of columns at a time, so that only small float64 temporaries are made.
+        """
+        if X.dtype == np.float64:
+            X[:] = A_lu.solve(X)
+            return
+
+        for j in range(0, X.shape[1], SOLVE_BLOCK_COLS):
+            cols = slice(j, j + SOLVE_BLOCK_COLS)
+            X[:, cols] = A_lu.solve(X[:, cols].astype(np.float64))
+
+    @staticmethod
+    def left_multiply(A, X, out=None):
+        """ `A @ X` (in float64, or into `out`).
+
+        Reduced-precision `X` is upcast a block of columns at a time, so that
+        no float64 copy of `X` is made.
+        """
+        if out is None:
+            out = np.empty((A.shape[0], X.shape[1]))
+
+        if X.dtype == np.float64:
+            out[:] = A @ X
+            return out
+
+        for j in range(0, X.shape[1], SOLVE_BLOCK_COLS):
+            cols = slice(j, j + SOLVE_BLOCK_COLS)
+            out[:, cols] = A @ X[:, cols].astype(np.float64)
+
+        return out
+
+    @staticmethod
+    def right_multiply(X, M, out=None):
+        """ `X @ M` (in float64, or into `out`, which may be `X`).
+
+        Reduced-precision `X` is upcast a block of rows at a time, so that no
+        float64 copy of `X` is made.
+        """
+        if X.dtype == np.float64:
+            return np.matmul(X, M, out=out)
+
+        if out is None:
+            out = np.empty(X.shape[:1] + M.shape[1:])
+
+        for i in range(0, X.shape[0], UPCAST_BLOCK_ROWS):
+            rows = slice(i, i + UPCAST_BLOCK_ROWS)
+            out[rows] = X[rows].astype(np.float64) @ M
+
+        return out
+
+    def marginal_var(self, H):
+        """ Variances of `H @ u`, from the covariance square-root. """
+        var = np.zeros((H.shape[0], ))
+        for j in range(0, self.cov_sqrt.shape[1], SOLVE_BLOCK_COLS):
+            cols = slice(j, j + SOLVE_BLOCK_COLS)
+            var += np.sum((H @ np.asarray(self.cov_sqrt[:, cols], dtype=np.float64))**2,
+                          axis=1)
+
+        return var
+
+    @staticmethod
+    def gram(X, out):
+        """ `X.T @ X` into (float64) `out`.
+
+        Reduced-precision `X` is upcast (and accumulated) a block of rows at
+        a time, so that no float64 copy of `X` is made.
+        """
+        if X.dtype == np.float64:
+            return np.matmul(X.T, X, out=out)
+
+        out[:] = 0.
+        for i in range(0, X.shape[0], UPCAST_BLOCK_ROWS):
+            block = X[i:(i + UPCAST_BLOCK_ROWS)].astype(np.float64)
+            out += block.T @ block
+
+        return out
+
+    def reduce_cov_sqrt(self, cov_sqrt=None):
+        """ Truncate `cov_sqrt` (default: the current factor) to rank `k`.
+
+        If `var_target` is set the rank is instead chosen adaptively.
+        """
+        if cov_sqrt is None:
+            if self.var_target is None and self.cov_sqrt.shape[1] <= self.k:
+                return
+
+            # copy out of the way, as the output overwrites the current factor
+            self.cov_sqrt_pred = self.buffer_view(self.cov_sqrt_pred_buf,
+                                                  self.cov_sqrt.shape[1])
+            self.cov_sqrt_pred[:] = self.cov_sqrt
+            cov_sqrt = self.cov_sqrt_pred
+
+        n_cols = cov_sqrt.shape[1]
+        self.n_reductions += 1
+        self.reduction_cost += n_cols**2
+
+        gram = self.gram_buf[:n_cols**2].reshape((n_cols, n_cols))
+        self.gram(cov_sqrt, gram)
+        D, V = eigh(gram, overwrite_a=True)
+        D, V = D[::-1], V[:, ::-1]
+
+        if self.var_target is None:
+            k = self.k
+        elif np.sum(D) > 0.:
+            var_prop = np.cumsum(D) / np.sum(D)
+            k = np.searchsorted(var_prop, self.var_target) + 1
+            k = int(np.clip(k, self.k_min, min(self.k_max, n_cols)))
+        else:
+            k = self.k_min
+
+        logger.debug("Prop. variance kept in the reduction: %f (rank %d)",
+                     np.sum(D[0:k]) / np.sum(D), k)
+
+        # kept eigenpairs of the Gram matrix (e.g. for smoother gains)
+        self.reduction_evd = (D[0:k].copy(), V[:, 0:k].copy())
+
+        self.cov_sqrt = self.buffer_view(self.cov_sqrt_buf, k)
+        self.right_multiply(cov_sqrt, V[:, 0:k], out=self.cov_sqrt)
+
+    def factor_innovation(self, y, H, sigma_y):
+        """ Factorise the innovation covariance, caching it for diagnostics.
+
+        Observation noise is diagonal, with standard deviations `sigma_y`
+        (scalar or per-observation). For the low-rank filter, when there are
+        more observations than the rank the (k x k) Woodbury form is used
+        (caching `C_chol`), otherwise the (n_obs x n_obs) innovation
+        covariance is factorised (caching `S_chol`). Returns `H @ cov_sqrt`
+        (or `H @ cov`).
+        """
         self.mean[:] = self.du.vector().get_local()
-        mean_obs = H @ self.mean
+        self.innov = y - H @ self.mean
+        n_obs = len(self.innov)
+        var_y = (sigma_y**2 + 1e-10) * np.ones((n_obs, ))
+        self.var_y = var_y
 
         if self.lr:
-            HL = H @ self.cov_sqrt
-            cov_obs = HL @ HL.T
+            HL = self.left_multiply(H, self.cov_sqrt)
+        else:
+            HL = H @ self.cov
+
+        if self.update_form == "auto":
+            woodbury = self.lr and n_obs > HL.shape[1]
         else:
-            HC = H @ self.cov
-            cov_obs = H @ self.cov @ H.T
+            woodbury = self.update_form == "woodbury"
 
-        cov_obs[np.diag_indices_from(cov_obs)] += sigma_y**2 + 1e-10
-        S_chol = cho_factor(cov_obs, lower=True)
-        S_inv_y = cho_solve(S_chol, y - mean_obs)
+        if woodbury:
+            # S^{-1} = R^{-1} - R^{-1} HL C^{-1} HL^T R^{-1}, C = I + HL^T R^{-1} HL
+            self.form = "woodbury"
+            HL_scaled = HL / np.sqrt(var_y)[:, np.newaxis]
+            C = HL_scaled.T @ HL_scaled
+            C[np.diag_indices_from(C)] += 1.
+            self.C_chol = cho_factor(C, lower=True)
+            self.S_chol = None
+            self.HL_factor = HL
 
-        # kalman updates: for high-dimensions this is the bottleneck
-        # TODO: avoid re-allocation and poor memory management
-        if self.lr:
-            HL = H @ self.cov_sqrt
-            S_inv_HL = cho_solve(S_chol, HL)
+            R_inv_innov = self.innov / var_y
+            self.C_inv_HL_innov = cho_solve(self.C_chol, HL.T @ R_inv_innov)
+            self.S_inv_innov = R_inv_innov - (HL @ self.C_inv_HL_innov) / var_y
+            self.log_det_S = (np.sum(np.log(var_y))
+                              + 2 * np.sum(np.log(np.diag(self.C_chol[0]))))
+        else:
+            self.form = "batch"
+            if self.lr:
+                cov_obs = HL @ HL.T
+            else:
+                cov_obs = HL @ H.T
+
+            cov_obs[np.diag_indices_from(cov_obs)] += var_y
+            self.S_chol = cho_factor(cov_obs, lower=True)
+            self.C_chol = None
+
+            self.S_inv_innov = cho_solve(self.S_chol, self.innov)
+            self.log_det_S = 2 * np.sum(np.log(np.diag(self.S_chol[0])))
+
+        return HL
+
+    def apply_S_inv(self, X):
+        """ Apply the inverse innovation covariance to `X`, from the cached factor. """
+        if self.form == "woodbury":
+            var_y = self.var_y.reshape((-1, ) + (1, ) * (X.ndim - 1))
+            R_inv_X = X / var_y
+            HL = self.HL_factor
+            return R_inv_X - (HL @ cho_solve(self.C_chol, HL.T @ R_inv_X)) / var_y
+        else:
+            return cho_solve(self.S_chol, X)
 
-            correction = self.cov_sqrt @ HL.T @ S_inv_y
+    def lml_from_factor(self):
+        """ Log-marginal likelihood, from the cached innovation factor. """
+        n_obs = len(self.innov)
+        return (- self.innov @ self.S_inv_innov / 2
+                - self.log_det_S / 2
+                - n_obs * np.log(2 * np.pi) / 2)
+
+    def update_from_factor(self, HL):
+        """ Kalman update, from the cached innovation factor. """
+        if self.form == "woodbury":
+            # posterior cov. is L C^{-1} L^T: right-multiply by C_chol^{-T}
+            correction = self.right_multiply(self.cov_sqrt, self.C_inv_HL_innov)
             self.mean += correction
+            for i in range(0, self.cov_sqrt.shape[0], UPCAST_BLOCK_ROWS):
+                rows = slice(i, i + UPCAST_BLOCK_ROWS)
+                self.cov_sqrt[rows] = solve_triangular(
+                    self.C_chol[0], self.cov_sqrt[rows].T, lower=True).T
+        elif self.lr:
+            S_inv_HL = cho_solve(self.S_chol, HL)
+            correction = self.right_multiply(self.cov_sqrt, HL.T @ self.S_inv_innov)
+            self.mean += correction
+
             R = cholesky(np.eye(HL.shape[1]) - HL.T @ S_inv_HL, lower=True)
-            self.cov_sqrt[:] = self.cov_sqrt @ R
+            self.right_multiply(self.cov_sqrt, R, out=self.cov_sqrt)
         else:
-            HC = H @ self.cov
-
-            correction = HC.T @ S_inv_y
-            S_inv_HC = cho_solve(S_chol, HC)
+            correction = HL.T @ self.S_inv_innov
             self.mean += correction
-            self.cov -= HC.T @ S_inv_HC
+            self.cov -= HL.T @ cho_solve(self.S_chol, HL)
 
         # update fenics state vector
         self.du.vector().set_local(self.mean.copy())
+        return correction
+
+    def serial_assimilate(self, y, H, sigma_y, update=True):
+        """ Process the observations one at a time (diagonal noise only).
+
+        Each scalar observation is a rank-1 (Potter) update to `cov_sqrt`, so
+        no dense (n_obs x n_obs) matrices or Cholesky factorisations are
+        needed. The posterior and the LML are the same as the batch update.
+        Returns the log-marginal likelihood and the correction to the mean.
+        """
+        H = csr_matrix(H)
+        n_obs = H.shape[0]
+        var_y = (sigma_y**2 + 1e-10) * np.ones((n_obs, ))
+
+        self.mean[:] = self.du.vector().get_local()
+        mean = self.mean if update else self.mean.copy()
+        cov_sqrt = self.cov_sqrt if update else self.cov_sqrt.copy()
+        mean_prior = self.mean.copy()
+
+        lml = - n_obs * np.log(2 * np.pi) / 2
+        for i in range(n_obs):
+            idx = H.indices[H.indptr[i]:H.indptr[i + 1]]
+            h = H.data[H.indptr[i]:H.indptr[i + 1]]
+
+            HL = h @ cov_sqrt[idx, :]
+            innov = y[i] - h @ mean[idx]
+            S = HL @ HL + var_y[i]
+            lml -= (innov**2 / S + np.log(S)) / 2
+
+            # mean update, then L <- L (I - beta HL^T HL)
+            L_HL = self.right_multiply(cov_sqrt, HL)
+            mean += L_HL * (innov / S)
+            beta = 1 / (S + np.sqrt(var_y[i] * S))
+            for j in range(0, cov_sqrt.shape[0], UPCAST_BLOCK_ROWS):
+                rows = slice(j, j + UPCAST_BLOCK_ROWS)
+                cov_sqrt[rows] -= beta * np.outer(L_HL[rows], HL)
+
+        if update:
+            self.du.vector().set_local(self.mean.copy())
+
+        return lml, mean - mean_prior
+
+    def compute_lml(self, y, H, sigma_y):
+        if self.update_form == "serial":
+            return self.serial_assimilate(y, H, sigma_y, update=False)[0]
+
+        self.factor_innovation(y, H, sigma_y)
+        return self.lml_from_factor()
+
+    def update_step(self, y, H, sigma_y, return_correction=False):
+        if self.update_form == "serial":
+            correction = self.serial_assimilate(y, H, sigma_y)[1]
+        else:
+            HL = self.factor_innovation(y, H, sigma_y)
+            correction = self.update_from_factor(HL)
 
         if return_correction:
             return correction
 
+    def assimilate(self, y, H, sigma_y):
+        """ Compute the LML and do the update, with a single factorisation.
+
+        Returns the log-marginal likelihood and the correction to the mean.
+        """
+        if self.update_form == "serial":
+            return self.serial_assimilate(y, H, sigma_y)
+
+        HL = self.factor_innovation(y, H, sigma_y)
+        lml = self.lml_from_factor()
+        return lml, self.update_from_factor(HL)
+
     def set_prev(self):
         """ Assign the current to the previous solution vector. """
         fe.assign(self.du_prev, self.du)
+        self.set_cov_prev()
+
+    def state_dict(self):
+        """ Filter state, as a dict of arrays, sufficient to resume a run.
+
+        Loading this into a freshly-constructed filter reproduces the run
+        exactly, except for an `lu_stale_tol` Jacobian LU, which is
+        refactorised on resuming (rather than re-using the stale factor).
+        Likewise the matrix-free preconditioner is not saved (it is an LU of
+        an earlier step's Jacobian), and is reassembled at the resumed state,
+        so matrix-free resumes agree to within `mf_tol`, not bit-for-bit.
+        """
+        state = dict(du=self.du.vector().get_local(),
+                     du_prev=self.du_prev.vector().get_local(),
+                     mean=self.mean.copy())
         if self.lr:
+            state.update(cov_sqrt=self.cov_sqrt.copy(),
+                         cov_sqrt_prev=self.cov_sqrt_prev.copy())
+        else:
+            state.update(cov=self.cov.copy(), cov_prev=self.cov_prev.copy())
+
+        return state
+
+    def load_state_dict(self, state):
+        self.du.vector().set_local(state["du"])
+        self.du_prev.vector().set_local(state["du_prev"])
+        self.mean[:] = state["mean"]
+        if self.lr:
+            self.cov_sqrt = self.buffer_view(self.cov_sqrt_buf, state["cov_sqrt"].shape[1])
+            self.cov_sqrt[:] = state["cov_sqrt"]
+            self.cov_sqrt_prev = self.buffer_view(self.cov_sqrt_prev_buf,
+                                                  state["cov_sqrt_prev"].shape[1])
+            self.cov_sqrt_prev[:] = state["cov_sqrt_prev"]
+        else:
+            self.cov[:] = state["cov"]
+            self.cov_prev[:] = state["cov_prev"]
+
+    def set_cov_prev(self):
+        """ Assign the current to the previous covariance (or its square-root). """
+        if self.lr:
+            self.cov_sqrt_prev = self.buffer_view(self.cov_sqrt_prev_buf,
+                                                  self.cov_sqrt.shape[1])
             self.cov_sqrt_prev[:] = self.cov_sqrt
         else:
             self.cov_prev[:] = self.cov
 
 
 class ShallowOneEx(ShallowOne, ShallowOneFilter):
-    def __init__(self, control, params, stat_params, lr=False):
-        ShallowOne.__init__(self, control=control, params=params)
+    def __init__(self, control, params, stat_params, lr=False, comm=None):
+        ShallowOne.__init__(self, control=control, params=params, comm=comm)
         ShallowOneFilter.__init__(self, stat_params=stat_params, lr=lr)
 
         self.J = fe.derivative(self.F, self.du)
         self.J_prev = fe.derivative(self.F, self.du_prev)
 
+        bcs = [self.bcs] if self.simulation == "immersed_bump" else self.bcs
+        self.bc_dofs = np.unique(np.concatenate(
+            [list(bc.get_boundary_values().keys()) for bc in bcs])).astype(np.int64)
+
+        # LU with re-used ordering (and optionally re-used, stale, factors)
+        self.J_scipy_lu = ReusableLU(stale_tol=control.get("lu_stale_tol", None),
+                                     max_iter=control.get("lu_max_iter", 3))
+
+        # matrix-free tangent-linear propagation of the covariance square-root:
+        # neither Jacobian is stored, and `J` is only assembled (into a
+        # temporary) when the preconditioner needs refreshing
+        self.matrix_free = control.get("matrix_free", False)
+        if self.matrix_free:
+            if not self.lr:
+                raise ValueError("Matrix-free propagation requires a low-rank filter")
+
+            self.J_action = FormAction(self.J, self.W, self.bc_dofs)
+            self.J_prev_action = FormAction(self.J_prev, self.W, self.bc_dofs)
+            self.J_mf_solver = MatrixFreeSolver(
+                self.J_action, self.assemble_jacobian_pc,
+                tol=control.get("mf_tol", 1e-10),
+                max_iter=control.get("mf_max_iter", 5))
+            return
+
+        # sparsity pattern is constant: build the CSR structure once, and
+        # re-use both the dolfin tensors and the CSR data buffers after this
         self.J_mat = fe.assemble(self.J)
         self.J_prev_mat = fe.assemble(self.J_prev)
 
         self.J_scipy = dolfin_to_csr(self.J_mat)
         self.J_prev_scipy = dolfin_to_csr(self.J_prev_mat)
 
+        self.J_bc_mask = csr_row_mask(self.J_scipy, self.bc_dofs)
+        self.J_prev_bc_mask = csr_row_mask(self.J_prev_scipy, self.bc_dofs)
+
+        self.assemble_derivatives()
+
     def prediction_step(self, t):
         if self.simulation == "tidal_flow":
             self.tidal_bc.t = t
@@ -193,24 +902,15 @@ class ShallowOneEx(ShallowOne, ShallowOneFilter):
         # fe.solve(self.F == 0, self.du, bcs=self.bcs, J=self.J)
         self.mean[:] = self.du.vector().get_local()
 
+        if self.matrix_free:
+            self.predict_cov_sqrt(self.J_prev_action, self.J_mf_solver)
+            return
+
         self.assemble_derivatives()
-        self.J_scipy_lu = splu(self.J_scipy.tocsc())
+        self.J_scipy_lu.update(self.J_scipy)
 
         if self.lr:
-            # push cov. forward
-            # print(self.J_prev_scipy.todense())
-            # print(self.J_prev_scipy @ self.cov_sqrt_prev)
-            self.cov_sqrt_pred[:, :self.k] = self.J_prev_scipy @ self.cov_sqrt_prev
-            self.cov_sqrt_pred[:, self.k:] = self.dt * self.G_sqrt
-            self.cov_sqrt_pred[:] = self.J_scipy_lu.solve(self.cov_sqrt_pred)
-
-            # perform reduction
-            # TODO avoid reallocation
-            D, V = eigh(self.cov_sqrt_pred.T @ self.cov_sqrt_pred)
-            D, V = D[::-1], V[:, ::-1]
-            logger.debug("Prop. variance kept in the reduction: %f",
-                         np.sum(D[0:self.k]) / np.sum(D))
-            np.dot(self.cov_sqrt_pred, V[:, 0:self.k], out=self.cov_sqrt)
+            self.predict_cov_sqrt(self.J_prev_scipy, self.J_scipy_lu)
         else:
             self.cov_pred[:] = (self.J_prev_scipy @ self.cov_prev @ self.J_prev_scipy.T
                                 + self.dt * self.G)
@@ -219,56 +919,299 @@ class ShallowOneEx(ShallowOne, ShallowOneFilter):
             self.cov[:] = self.J_scipy_lu.solve(self.cov_pred.T)
 
     def assemble_derivatives(self):
-        self.J_mat = fe.assemble(self.J)
-        self.J_prev_mat = fe.assemble(self.J_prev)
+        self.assemble_jacobian()
+        fe.assemble(self.J_prev, tensor=self.J_prev_mat)
+        self.set_csr_data(self.J_prev_mat, self.J_prev_scipy, self.J_prev_bc_mask)
 
-        # TODO: check application of temporally-varying BC
-        for J in [self.J_mat, self.J_prev_mat]:
-            if self.simulation == "immersed_bump":
-                self.bcs.apply(J)
-            else:
-                for bc in self.bcs: bc.apply(J)
+    def assemble_jacobian(self):
+        """ Assemble `J` only, returning the (persistent) CSR matrix. """
+        fe.assemble(self.J, tensor=self.J_mat)
+        self.set_csr_data(self.J_mat, self.J_scipy, self.J_bc_mask)
+        return self.J_scipy
 
-        # TODO: make use of constant sparsity pattern
-        self.J_scipy = dolfin_to_csr(self.J_mat)
-        self.J_prev_scipy = dolfin_to_csr(self.J_prev_mat)
+    def assemble_jacobian_pc(self):
+        """ Assemble `J` into a new CSR matrix (for the matrix-free preconditioner). """
+        J_scipy = dolfin_to_csr(fe.assemble(self.J))
+        mask, diag = csr_row_mask(J_scipy, self.bc_dofs)
+        J_scipy.data[mask] = 0.
+        J_scipy.data[diag] = 1.
+        return J_scipy
+
+    @staticmethod
+    def set_csr_data(J_mat, J_scipy, bc_mask):
+        """ Copy into the persistent CSR buffer, then apply the BC rows.
+
+        BC rows are zeroed with ones on the diagonal (as `DirichletBC.apply`).
+        """
+        mask, diag = bc_mask
+        J_scipy.data[:] = fe.as_backend_type(J_mat).mat().getValuesCSR()[2]
+        J_scipy.data[mask] = 0.
+        J_scipy.data[diag] = 1.
 
 
 class ShallowOneKalman(ShallowOneLinear, ShallowOneFilter):
-    def __init__(self, control, params, stat_params, lr=False):
-        ShallowOneLinear.__init__(self, control=control, params=params)
+    def __init__(self, control, params, stat_params, lr=False, comm=None):
+        ShallowOneLinear.__init__(self, control=control, params=params, comm=comm)
         ShallowOneFilter.__init__(self, stat_params=stat_params, lr=lr)
 
-        self.A_mat = fe.assemble(self.a)
-        self.A_prev = fe.derivative(self.l, self.du_prev)
-        self.A_prev_mat = fe.assemble(self.A_prev)
+        # propagators are needed for the covariance, regardless of stepping
+        if not self.prefactored:
+            self.setup_prefactored()
+
+        # jump the covariance between observations, via repeated squaring
+        self.cov_doubling = stat_params.get("cov_doubling", False)
+        if self.cov_doubling:
+            if not self.lr:
+                raise ValueError("Covariance doubling requires a low-rank filter")
+
+            self.k_doubling = stat_params.get("k_doubling", self.k_max + self.k_noise)
+            self.n_cov_pending = 0
+            self.setup_doubling()
+
+        # freeze the gain once it has converged, falling back if the NIS drifts
+        self.steady_state = stat_params.get("steady_state", False)
+        if self.steady_state:
+            if self.update_form == "serial":
+                raise ValueError("Steady-state gain requires a cached innovation factor")
+
+            self.ss_tol = stat_params.get("ss_tol", 1e-6)
+            self.ss_n_stable = stat_params.get("ss_n_stable", 3)
+            self.ss_window = stat_params.get("ss_window", 20)
+            self.ss_nis_tol = stat_params.get("ss_nis_tol", 2.)
+
+        self.frozen = False
+        self.n_stable = 0
+        self.K_ss = None
+
+    def setup_doubling(self):
+        """ Set up the one-step propagator and process-noise factor.
+
+        `Phi_pows[j]` is the (dense) propagator over `2^j` steps, and
+        `noise_pows[j]` the (compressed) accumulated noise factor.
+        """
+        Phi = self.A_scipy_lu.solve(self.A_prev_scipy.toarray())
+        noise = self.A_scipy_lu.solve(self.dt * self.G_sqrt)
+        self.Phi_pows = [Phi]
+        self.noise_pows = [noise]
+
+    def doubling_level(self, j):
+        while len(self.Phi_pows) <= j:
+            Phi, noise = self.Phi_pows[-1], self.noise_pows[-1]
+            self.noise_pows.append(
+                compress_sqrt(np.hstack([Phi @ noise, noise]), self.k_doubling))
+            self.Phi_pows.append(Phi @ Phi)
+
+        return self.Phi_pows[j], self.noise_pows[j]
+
+    def sync_cov_sqrt(self):
+        """ Jump `cov_sqrt` forward over all the steps deferred so far. """
+        if not self.cov_doubling or self.n_cov_pending == 0:
+            return
+
+        cov_sqrt = self.cov_sqrt
+        for j in range(int(self.n_cov_pending).bit_length()):
+            if (self.n_cov_pending >> j) & 1:
+                Phi, noise = self.doubling_level(j)
+                cov_sqrt = compress_sqrt(np.hstack([Phi @ cov_sqrt, noise]),
+                                         self.k_doubling)
 
-        for A in [self.A_mat, self.A_prev_mat]:
-            for bc in self.bcs:
-                bc.apply(A)
+        # reduce as usual, from the leading columns (sorted by variance)
+        n_cols = min(cov_sqrt.shape[1], self.k_max + self.k_noise)
+        self.cov_sqrt_pred = self.buffer_view(self.cov_sqrt_pred_buf, n_cols)
+        self.cov_sqrt_pred[:] = cov_sqrt[:, :n_cols]
+        self.reduce_cov_sqrt(self.cov_sqrt_pred)
+        self.n_cov_pending = 0
 
-        self.A_scipy = dolfin_to_csr(self.A_mat)
-        self.A_scipy_lu = splu(self.A_scipy.tocsc())
-        self.A_prev_scipy = dolfin_to_csr(self.A_prev_mat)
+    def get_cov_state(self):
+        return (self.cov_sqrt if self.lr else self.cov).copy()
+
+    def set_cov_state(self, cov):
+        if self.lr:
+            self.cov_sqrt = self.buffer_view(self.cov_sqrt_buf, cov.shape[1])
+            self.cov_sqrt[:] = cov
+        else:
+            self.cov[:] = cov
+
+    def factor_innovation(self, y, H, sigma_y):
+        """ As `ShallowOneFilter.factor_innovation`, re-using the frozen factor
+        when the gain is at steady-state.
+
+        The normalised innovation squared (NIS) is tracked over the last
+        `ss_window` observation times; if its mean leaves
+        `[1 / ss_nis_tol, ss_nis_tol]` the gain is unfrozen, and full
+        covariance propagation resumes from the steady-state prior.
+        """
+        if not self.frozen:
+            return ShallowOneFilter.factor_innovation(self, y, H, sigma_y)
+
+        self.mean[:] = self.du.vector().get_local()
+        self.innov = y - H @ self.mean
+        self.S_inv_innov = self.apply_S_inv(self.innov)
+
+        self.nis.append(self.innov @ self.S_inv_innov / len(self.innov))
+        if len(self.nis) == self.ss_window:
+            nis = np.mean(self.nis)
+            if nis > self.ss_nis_tol or nis < 1 / self.ss_nis_tol:
+                logger.info("NIS drifted to %.3f, unfreezing the gain", nis)
+                self.frozen = False
+                self.n_stable = 0
+                self.K_ss = None
+                self.set_cov_state(self.cov_prior_ss)
+                return ShallowOneFilter.factor_innovation(self, y, H, sigma_y)
+
+        return None
+
+    def update_from_factor(self, HL):
+        """ Kalman update, which only updates the mean if the gain is frozen. """
+        if self.frozen:
+            correction = self.K_ss @ self.innov
+            self.mean += correction
+            self.du.vector().set_local(self.mean.copy())
+
+            # report the steady-state posterior covariance
+            self.set_cov_state(self.cov_post_ss)
+            self.ss_posterior = True
+            return correction
+
+        if not self.steady_state:
+            return ShallowOneFilter.update_from_factor(self, HL)
+
+        # gain is L (S^{-1} H L)^T, or (S^{-1} H C)^T for the full covariance
+        S_inv_HL = self.apply_S_inv(HL)
+        K = (self.cov_sqrt @ S_inv_HL.T) if self.lr else S_inv_HL.T
+        cov_prior = self.get_cov_state()
+        correction = ShallowOneFilter.update_from_factor(self, HL)
+
+        if (self.K_ss is not None and K.shape == self.K_ss.shape
+                and np.linalg.norm(K - self.K_ss) <= self.ss_tol * np.linalg.norm(K)):
+            self.n_stable += 1
+        else:
+            self.n_stable = 0
+
+        self.K_ss = K
+        if self.n_stable >= self.ss_n_stable:
+            logger.info("Gain converged, freezing at steady-state")
+            self.freeze_gain(cov_prior)
+
+        return correction
+
+    def freeze_gain(self, cov_prior):
+        """ Freeze the current gain and innovation factor.
+
+        The covariance is no longer propagated: it is reported as the
+        steady-state posterior right after an update, and as the
+        steady-state prior (at observation times) otherwise.
+        """
+        self.frozen = True
+        self.cov_prior_ss = cov_prior
+        self.cov_post_ss = self.get_cov_state()
+        self.ss_posterior = True
+        self.nis = deque(maxlen=self.ss_window)
+        if self.cov_doubling:
+            self.n_cov_pending = 0
+
+    def precompute_steady_state(self, H, sigma_y, nt_skip, max_cycles=1000):
+        """ Iterate the covariance (only) to steady-state, offline.
+
+        Observations (via `H`, `sigma_y`) are assumed every `nt_skip` steps. The
+        mean is left unchanged, and on return the gain is frozen, ready to be
+        used from the start of the run. Returns the number of cycles needed.
+        """
+        if not self.steady_state:
+            raise ValueError("Set `steady_state` in stat_params to precompute the gain")
+
+        for i in range(max_cycles):
+            for j in range(nt_skip):
+                self.set_cov_prev()
+                if self.lr:
+                    self.predict_cov_sqrt(self.A_prev_scipy, self.A_scipy_lu)
+                else:
+                    self.cov_pred[:] = (
+                        self.A_prev_scipy @ self.cov_prev @ self.A_prev_scipy.T
+                        + self.dt * self.G)
+                    self.cov_pred[:] = self.A_scipy_lu.solve(self.cov_pred)
+                    self.cov[:] = self.A_scipy_lu.solve(self.cov_pred.T)
+
+            # reduce as at observation times in the run
+            if self.lr and self.reduction == "obs":
+                self.reduce_cov_sqrt()
+
+            # zero innovation: only the covariance is updated
+            mean = self.du.vector().get_local()
+            HL = ShallowOneFilter.factor_innovation(self, H @ mean, H, sigma_y)
+            self.update_from_factor(HL)
+            if self.frozen:
+                break
+        else:
+            logger.warning("Gain did not converge in %d cycles", max_cycles)
+
+        self.set_cov_prev()
+        return i + 1
+
+    def state_dict(self):
+        state = ShallowOneFilter.state_dict(self)
+        if self.cov_doubling:
+            state["n_cov_pending"] = self.n_cov_pending
+
+        if self.steady_state:
+            state.update(frozen=self.frozen, n_stable=self.n_stable)
+            if self.K_ss is not None:
+                state["K_ss"] = self.K_ss
+
+            # the frozen gain also needs the frozen innovation factor
+            if self.frozen:
+                state.update(cov_prior_ss=self.cov_prior_ss,
+                             cov_post_ss=self.cov_post_ss,
+                             ss_posterior=self.ss_posterior,
+                             nis=np.array(self.nis),
+                             var_y=self.var_y,
+                             log_det_S=self.log_det_S,
+                             woodbury=self.form == "woodbury")
+                if self.form == "woodbury":
+                    state.update(C_chol=self.C_chol[0], HL_factor=self.HL_factor)
+                else:
+                    state.update(S_chol=self.S_chol[0])
+
+        return state
+
+    def load_state_dict(self, state):
+        ShallowOneFilter.load_state_dict(self, state)
+        if self.cov_doubling:
+            self.n_cov_pending = int(state["n_cov_pending"])
+
+        if self.steady_state:
+            self.frozen = bool(state["frozen"])
+            self.n_stable = int(state["n_stable"])
+            self.K_ss = state.get("K_ss", None)
+
+            if self.frozen:
+                self.cov_prior_ss = state["cov_prior_ss"]
+                self.cov_post_ss = state["cov_post_ss"]
+                self.ss_posterior = bool(state["ss_posterior"])
+                self.nis = deque(state["nis"], maxlen=self.ss_window)
+                self.var_y = state["var_y"]
+                self.log_det_S = float(state["log_det_S"])
+                if state["woodbury"]:
+                    self.form = "woodbury"
+                    self.C_chol = (state["C_chol"], True)
+                    self.HL_factor = state["HL_factor"]
+                else:
+                    self.form = "batch"
+                    self.S_chol = (state["S_chol"], True)
 
     def prediction_step(self, t):
-        self.tidal_bc.t = t
-        self.solver.solve()
+        self.solve(t, set_prev=False)
         self.mean[:] = self.du.vector().get_local()
 
-        if self.lr:
-            # push cov. forward
-            self.cov_sqrt_pred[:, :self.k] = self.A_prev_scipy @ self.cov_sqrt_prev
-            self.cov_sqrt_pred[:, self.k:] = self.dt * self.G_sqrt
-            self.cov_sqrt_pred[:] = self.A_scipy_lu.solve(self.cov_sqrt_pred)
-
-            # perform reduction
-            # TODO avoid reallocation
-            D, V = eigh(self.cov_sqrt_pred.T @ self.cov_sqrt_pred)
-            D, V = D[::-1], V[:, ::-1]
-            logger.debug("Prop. variance kept in the reduction: %f",
-                         np.sum(D[0:self.k]) / np.sum(D))
-            np.dot(self.cov_sqrt_pred, V[:, 0:self.k], out=self.cov_sqrt)
+        if self.frozen:
+            # report the steady-state prior, until the next update
+            if self.ss_posterior:
+                self.set_cov_state(self.cov_prior_ss)
+                self.ss_posterior = False
+        elif self.lr and self.cov_doubling:
+            self.n_cov_pending += 1
+        elif self.lr:
+            self.predict_cov_sqrt(self.A_prev_scipy, self.A_scipy_lu)
         else:
             self.cov_pred[:] = (
                 self.A_prev_scipy @ self.cov_prev @ self.A_prev_scipy.T
@@ -276,3 +1219,99 @@ class ShallowOneKalman(ShallowOneLinear, ShallowOneFilter):
 
             self.cov_pred[:] = self.A_scipy_lu.solve(self.cov_pred)
             self.cov[:] = self.A_scipy_lu.solve(self.cov_pred.T)
+
+
+class ShallowOneEnKF(ShallowOne, ShallowOneFilter):
+    """ Ensemble square-root Kalman filter on the nonlinear model.
+
+    The `k` ensemble members are propagated through the full model (re-using
+    the one compiled form/solver), with process noise entering as a forcing
+    term. The low-rank machinery of `ShallowOneFilter` is shared, with
+    `cov_sqrt` being the scaled ensemble anomalies; updates use a symmetric
+    square-root so that the anomalies remain centred.
+    """
+    def __init__(self, control, params, stat_params, comm=None):
+        ShallowOne.__init__(self, control=control, params=params, comm=comm)
+        ShallowOneFilter.__init__(self, stat_params=stat_params, lr=True)
+        self.n_ens = self.k
+        if self.reduction != "step" or self.var_target is not None:
+            raise ValueError("EnKF requires a fixed ensemble size")
+
+        # noise forcing: M @ xi = dt * G_sqrt @ z, for z ~ N(0, I)
+        v = fe.TestFunction(self.W)
+        self.M_scipy_lu = splu(self.mass_matrix("w").tocsc())
+
+        self.xi = fe.Function(self.W)
+        self.F_noise = self.F - fe.inner(self.xi, v) * fe.dx
+        self.setup_solver(self.F_noise, self.J)
+
+        self.ens = np.tile(self.mean[:, np.newaxis], (1, self.n_ens))
+        self.ens_prev = self.ens.copy()
+        self.xi_ens = np.zeros_like(self.ens)
+
+    def prediction_step(self, t):
+        if self.simulation == "tidal_flow":
+            self.tidal_bc.t = t
+
+        z = np.random.normal(size=(self.k_noise, self.n_ens))
+        self.xi_ens[:] = self.M_scipy_lu.solve(self.dt * (self.noise @ z))
+
+        for i in range(self.n_ens):
+            self.du_prev.vector().set_local(self.ens_prev[:, i])
+            self.du.vector().set_local(self.ens_prev[:, i])
+            self.xi.vector().set_local(self.xi_ens[:, i])
+            self.solver.solve()
+            self.ens[:, i] = self.du.vector().get_local()
+
+        self.set_moments()
+
+    def set_moments(self):
+        """ Set the mean and `cov_sqrt` from the ensemble. """
+        self.mean[:] = np.mean(self.ens, axis=1)
+        self.cov_sqrt[:] = ((self.ens - self.mean[:, np.newaxis])
+                            / np.sqrt(self.n_ens - 1))
+        self.du.vector().set_local(self.mean.copy())
+
+    def set_ensemble(self):
+        """ Set the ensemble from the mean and `cov_sqrt`. """
+        self.ens[:] = (self.mean[:, np.newaxis]
+                       + np.sqrt(self.n_ens - 1) * self.cov_sqrt)
+
+    def update_from_factor(self, HL):
+        """ ETKF update: `cov_sqrt <- cov_sqrt @ T`, with `T` symmetric. """
+        if self.form == "woodbury":
+            T_sq = cho_solve(self.C_chol, np.eye(HL.shape[1]))
+        else:
+            T_sq = np.eye(HL.shape[1]) - HL.T @ cho_solve(self.S_chol, HL)
+
+        correction = self.cov_sqrt @ (HL.T @ self.S_inv_innov)
+        self.mean += correction
+
+        D, V = eigh(T_sq)
+        self.cov_sqrt[:] = self.cov_sqrt @ (V * np.sqrt(np.maximum(D, 0.))) @ V.T
+        self.du.vector().set_local(self.mean.copy())
+        self.set_ensemble()
+        return correction
+
+    def serial_assimilate(self, y, H, sigma_y, update=True):
+        # Potter updates keep the anomalies centred
+        lml, correction = ShallowOneFilter.serial_assimilate(
+            self, y, H, sigma_y, update=update)
+        if update:
+            self.set_ensemble()
+
+        return lml, correction
+
+    def set_prev(self):
+        ShallowOneFilter.set_prev(self)
+        self.ens_prev[:] = self.ens
+
+    def state_dict(self):
+        state = ShallowOneFilter.state_dict(self)
+        state.update(ens=self.ens.copy(), ens_prev=self.ens_prev.copy())
+        return state
+
+    def load_state_dict(self, state):
+        ShallowOneFilter.load_state_dict(self, state)
+        self.ens[:] = state["ens"]
+        self.ens_prev[:] = state["ens_prev"]
@@ -0,0 +1,158 @@
+""" Fixed-interval (RTS) smoothing for the low-rank filters. """
+import logging
+import os
+
+import h5py
+import numpy as np
+
+from scipy.linalg import eigh
+from swe_filter import compress_sqrt
+
+# initialise the logger
+logger = logging.getLogger(__name__)
+
+
+class RTSSmoother:
+    """ Rauch-Tung-Striebel smoother on top of a low-rank filter.
+
+    The forward pass streams the filtered means and factors, the predicted
+    means, and the (small) eigenpairs of each rank reduction to a chunked
+    HDF5 file, so that the full history is never held in memory. The
+    predicted factor is only stored when it differs from the filtered factor
+    (i.e. at observation times). The backward pass then reads the history in
+    reverse, one step at a time.
+
+    With the predicted factor `L_pred = [F L, Q^{1/2}] V_k` (the reduction of
+    the filtered factor `L` pushed forward), the smoother gain is
+    `J = L V_rk D_k^{-1} L_pred^T`, where `V_rk` are the first `r = rank(L)`
+    rows of `V_k`. The smoothed covariance is then
+    `L (I - V_rk V_rk^T) L^T + J P_s J^T`, which is compressed back to rank
+    `k_max`.
+
+    The history is large (a factor per step), so factors are stored at
+    `dtype` (default float32) in compressed chunks, and the file is deleted
+    on `close` unless `keep` is set.
+    """
+    def __init__(self, swe, filename, nt, dtype=np.float32, compression="gzip",
+                 keep=False):
+        if not swe.lr or swe.reduction != "step":
+            raise ValueError("Smoothing requires a low-rank filter, reduced every step")
+        if getattr(swe, "cov_doubling", False) or getattr(swe, "steady_state", False):
+            raise ValueError("Smoothing requires the covariance at every step")
+        if hasattr(swe, "n_ens"):
+            raise ValueError("Smoothing is not implemented for the EnKF")
+
+        self.swe = swe
+        self.nt = nt
+        self.n_dofs = swe.mean.shape[0]
+        self.k_max = swe.k_max
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.keep = keep
+
+        n, k = self.n_dofs, self.k_max
+        self.store = h5py.File(filename, "w")
+        self.store.create_dataset("mean", (nt + 1, n), chunks=(1, n), dtype=np.float64)
+        self.store.create_dataset("mean_pred", (nt, n), chunks=(1, n), dtype=np.float64)
+        self.store.create_dataset("cov_sqrt", (nt + 1, n, k), chunks=(1, n, k),
+                                  dtype=self.dtype, compression=compression,
+                                  shuffle=compression is not None)
+        self.store.create_dataset("cov_sqrt_pred", (0, n, k), maxshape=(None, n, k),
+                                  chunks=(1, n, k), dtype=self.dtype,
+                                  compression=compression,
+                                  shuffle=compression is not None)
+        self.store.create_dataset("rank", (nt + 1, ), dtype=np.int64)
+        self.store.create_dataset("rank_prev", (nt, ), dtype=np.int64)
+        self.store.create_dataset("pred_index", data=-np.ones((nt, ), dtype=np.int64))
+        self.store.create_dataset("evd_vals", (nt, k), chunks=(1, k), dtype=np.float64)
+        self.store.create_dataset("evd_vecs", (nt, k, k), chunks=(1, k, k),
+                                  dtype=np.float64)
+
+        self.i_pred = None
+        self.n_pred = 0
+
+    def write_factor(self, name, i, cov_sqrt):
+        r = cov_sqrt.shape[1]
+        factor = np.zeros((self.n_dofs, self.k_max), dtype=self.dtype)
+        factor[:, :r] = cov_sqrt
+        self.store[name][i] = factor
+
+    def record_initial(self):
+        """ Store the initial condition. """
+        self.store["mean"][0] = self.swe.mean
+        self.store["rank"][0] = self.swe.cov_sqrt.shape[1]
+        self.write_factor("cov_sqrt", 0, self.swe.cov_sqrt)
+
+    def record_prediction(self, i):
+        """ Store the prediction from step `i` (to state `i + 1`). """
+        D, V = self.swe.reduction_evd
+        k_prev, k = self.swe.k_prev, len(D)
+
+        self.store["mean_pred"][i] = self.swe.mean
+        self.store["rank_prev"][i] = k_prev
+        self.store["evd_vals"][i, :k] = D
+        vecs = np.zeros((self.k_max, self.k_max))
+        vecs[:k_prev, :k] = V[:k_prev, :]
+        self.store["evd_vecs"][i] = vecs
+
+        # filtered == predicted, until an update says otherwise
+        self.store["mean"][i + 1] = self.swe.mean
+        self.store["rank"][i + 1] = k
+        self.write_factor("cov_sqrt", i + 1, self.swe.cov_sqrt)
+        self.i_pred = i
+
+    def record_update(self):
+        """ Store the update of the last prediction (at an observation time). """
+        i = self.i_pred
+        self.store["cov_sqrt_pred"].resize(self.n_pred + 1, axis=0)
+        self.store["cov_sqrt_pred"][self.n_pred] = self.store["cov_sqrt"][i + 1]
+        self.store["pred_index"][i] = self.n_pred
+        self.n_pred += 1
+
+        self.store["mean"][i + 1] = self.swe.mean
+        self.store["rank"][i + 1] = self.swe.cov_sqrt.shape[1]
+        self.write_factor("cov_sqrt", i + 1, self.swe.cov_sqrt)
+
+    def backward(self):
+        """ Run the backward pass, yielding `(i, mean, cov_sqrt)` from `i = nt`. """
+        store = self.store
+        rank, rank_prev = store["rank"][:], store["rank_prev"][:]
+        pred_index = store["pred_index"][:]
+
+        mean_smooth = store["mean"][self.nt]
+        cov_sqrt_smooth = store["cov_sqrt"][self.nt][:, :rank[self.nt]].astype(np.float64)
+        cov_sqrt_next = cov_sqrt_smooth
+        yield self.nt, mean_smooth, cov_sqrt_smooth
+
+        for i in reversed(range(self.nt)):
+            mean = store["mean"][i]
+            cov_sqrt = store["cov_sqrt"][i][:, :rank[i]].astype(np.float64)
+            k, r = rank[i + 1], rank_prev[i]
+            if pred_index[i] >= 0:
+                cov_sqrt_pred = store["cov_sqrt_pred"][pred_index[i]][:, :k].astype(np.float64)
+            else:
+                cov_sqrt_pred = cov_sqrt_next
+
+            D = store["evd_vals"][i, :k]
+            V = store["evd_vecs"][i][:r, :k]
+            D_inv = np.zeros_like(D)
+            nonzero = D > 1e-12 * np.max(D, initial=0.)
+            D_inv[nonzero] = 1 / D[nonzero]
+
+            # gain J = W @ cov_sqrt_pred.T
+            W = cov_sqrt @ (V * D_inv)
+            mean_smooth = mean + W @ (cov_sqrt_pred.T @ (mean_smooth - store["mean_pred"][i]))
+
+            E, U = eigh(np.eye(r) - V @ V.T)
+            cov_sqrt_smooth = compress_sqrt(
+                np.hstack([cov_sqrt @ (U * np.sqrt(np.maximum(E, 0.))),
+                           W @ (cov_sqrt_pred.T @ cov_sqrt_smooth)]),
+                self.k_max)
+            cov_sqrt_next = cov_sqrt
+            yield i, mean_smooth, cov_sqrt_smooth
+
+    def close(self):
+        """ Close (and, unless `keep` is set, delete) the history file. """
+        self.store.close()
+        if not self.keep and os.path.exists(self.filename):
+            os.remove(self.filename)
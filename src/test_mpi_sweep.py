@@ -0,0 +1,111 @@
+import time
+import threading
+
+from collections import Counter
+from types import SimpleNamespace
+
+from mpi_sweep import schedule, work
+
+
+class Status:
+    def __init__(self):
+        self.source = None
+
+    def Get_source(self):
+        return self.source
+
+
+# stands in for mpi4py's MPI module
+fake_mpi = SimpleNamespace(Status=Status, ANY_SOURCE=-1)
+
+
+class FakeComm:
+    """ In-process communicator: one inbox of `(source, msg)` per rank. """
+
+    def __init__(self, rank, inboxes, lock):
+        self.rank, self.inboxes, self.lock = rank, inboxes, lock
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return len(self.inboxes)
+
+    def send(self, msg, dest):
+        with self.lock:
+            self.inboxes[dest].append((self.rank, msg))
+            self.lock.notify_all()
+
+    def find(self, source):
+        for n, (src, _) in enumerate(self.inboxes[self.rank]):
+            if source in (src, fake_mpi.ANY_SOURCE):
+                return n
+
+    def Iprobe(self, source, status=None):
+        with self.lock:
+            n = self.find(source)
+            if n is not None and status is not None:
+                status.source = self.inboxes[self.rank][n][0]
+            return n is not None
+
+    def recv(self, source):
+        with self.lock:
+            self.lock.wait_for(lambda: self.find(source) is not None)
+            return self.inboxes[self.rank].pop(self.find(source))[1]
+
+
+def run_sweep(jobs, costs, run, n_ranks, **kwargs):
+    lock = threading.Condition()
+    inboxes = [[] for _ in range(n_ranks)]
+    workers = [threading.Thread(target=work, args=(FakeComm(rank, inboxes, lock), run))
+               for rank in range(1, n_ranks)]
+    for worker in workers:
+        worker.start()
+
+    results = list(schedule(FakeComm(0, inboxes, lock), jobs, costs, mpi=fake_mpi,
+                            poll_interval=1e-3, **kwargs))
+    for worker in workers:
+        worker.join()
+
+    return results
+
+
+def test_schedule():
+    # jobs are durations, and return their squares
+    def run(job, check_cancel):
+        time.sleep(job)
+        return job**2
+
+    jobs = [0.05, 0.01, 0.02, 0.01, 0.03]
+    results = run_sweep(jobs, jobs, run, 3, straggler_factor=1e3)
+    assert sorted(j for j, *_ in results) == list(range(len(jobs)))
+    assert all(out == jobs[j]**2 and first for j, _, out, _, first in results)
+    assert {rank for _, rank, *_ in results} == {1, 2}
+
+
+def test_schedule_stragglers():
+    # the first copy of job 0 hangs (until it is cancelled)
+    calls = Counter()
+    lock = threading.Lock()
+
+    def run(job, check_cancel):
+        with lock:
+            calls[job] += 1
+            hang = job == 0 and calls[job] == 1
+
+        start = time.time()
+        while time.time() - start < (60. if hang else 0.02):
+            check_cancel()
+            time.sleep(1e-3)
+
+        return job
+
+    start = time.time()
+    results = run_sweep(list(range(4)), [1.] * 4, run, 3, straggler_factor=3.)
+    assert time.time() - start < 10.
+
+    # the duplicate finishes first, and the hung copy is cancelled
+    assert calls[0] == 2
+    copies = [(out, first) for j, _, out, _, first in results if j == 0]
+    assert copies == [(0, True), (None, False)]
+    assert all(first for j, *_, first in results if j != 0)
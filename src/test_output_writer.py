@@ -0,0 +1,41 @@
+import h5py
+import numpy as np
+
+from numpy.testing import assert_allclose
+from output_writer import StreamingWriter
+
+
+def test_streaming_writer(tmp_path):
+    output_file = tmp_path / "output.h5"
+    rows = np.random.normal(size=(10, 3))
+
+    with h5py.File(output_file, "w") as output:
+        writer = StreamingWriter(output, chunk_rows=4)
+        writer.create("x", (3, ), length=12)
+        writer.create("t")
+        for i in range(10):
+            writer.write("x", i, rows[i])
+            writer.write("t", i, float(i))
+
+        # overwriting is allowed, and flushing makes partial outputs visible
+        writer.write("x", 0, np.zeros((3, )))
+        writer.flush()
+        assert output["x"].shape == (10, 3)
+        assert output["x"].compression == "gzip"
+
+        writer.close()
+
+    with h5py.File(output_file, "r") as output:
+        assert output["x"].shape == (12, 3)
+        assert_allclose(output["x"][0], 0.)
+        assert_allclose(output["x"][1:10], rows[1:])
+        assert_allclose(output["x"][10:], 0.)
+        assert_allclose(output["t"][:], np.arange(10))
+
+    # resuming re-uses the existing datasets
+    with h5py.File(output_file, "r+") as output:
+        writer = StreamingWriter(output)
+        writer.create("t", length=12)
+        writer.write("t", 10, 10.)
+        writer.close()
+        assert_allclose(output["t"][:], np.r_[np.arange(11), 0.])
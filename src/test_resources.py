@@ -0,0 +1,32 @@
+from resources import (THREAD_VARS, available_cores, core_sets, plan_layout, thread_count,
+                       thread_env)
+
+
+def test_plan_layout():
+    # more jobs than cores: one thread per worker
+    assert plan_layout(16, 100) == (16, 1)
+
+    # fewer jobs than cores: the spare cores go to threads
+    assert plan_layout(16, 3) == (3, 5)
+    assert plan_layout(16, 0) == (1, 16)
+
+    # the threads per worker can be fixed
+    assert plan_layout(16, 100, 4) == (4, 4)
+    assert plan_layout(4, 100, 8) == (1, 4)
+
+
+def test_core_sets():
+    sets = core_sets(list(range(8)), 3, 2)
+    assert sets == [[0, 1], [2, 3], [4, 5]]
+    assert all(val == "2" for val in thread_env(2).values())
+
+
+def test_thread_count(monkeypatch):
+    for name in THREAD_VARS:
+        monkeypatch.delenv(name, raising=False)
+    assert thread_count() == len(available_cores())
+
+    monkeypatch.setenv("OPENBLAS_NUM_THREADS", "3")
+    assert thread_count() == 3
+    monkeypatch.setenv("OMP_NUM_THREADS", "2")
+    assert thread_count() == 2
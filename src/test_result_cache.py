@@ -0,0 +1,39 @@
+import h5py
+import numpy as np
+
+from numpy.testing import assert_allclose
+from result_cache import ResultCache, config_key, file_digest
+
+
+def test_config_key():
+    config = dict(control=dict(nx=500, dt=1.), k=32, data="abc")
+    assert config_key(config) == config_key(dict(k=32, data="abc",
+                                                 control=dict(dt=1., nx=500)))
+    assert config_key(config) != config_key({**config, "k": 64})
+    assert config_key(config) != config_key({**config, "control": dict(nx=500, dt=2.)})
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    output_file = str(tmp_path / "output.h5")
+    key = config_key(dict(k=32))
+
+    # unfinished outputs aren't stored
+    with h5py.File(output_file, "w") as f:
+        f.create_dataset("x", data=np.arange(5.))
+    assert not cache.store(key, output_file)
+    assert not cache.fetch(key, output_file)
+
+    with h5py.File(output_file, "r+") as f:
+        f.attrs.create("complete", True)
+    assert not cache.is_current(key, output_file)
+    assert cache.store(key, output_file)
+    assert cache.is_current(key, output_file)
+    assert not cache.is_current(config_key(dict(k=64)), output_file)
+
+    # hits are copies of the stored output
+    other_file = str(tmp_path / "other.h5")
+    assert cache.fetch(key, other_file)
+    assert file_digest(other_file) == file_digest(output_file)
+    with h5py.File(other_file, "r") as f:
+        assert_allclose(f["x"][:], np.arange(5.))
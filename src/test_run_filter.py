@@ -0,0 +1,215 @@
+import os
+import h5py
+import pytest
+import numpy as np
+import xarray as xr
+
+from numpy.testing import assert_allclose, assert_array_equal
+from statfenics.utils import build_observation_operator
+
+from output_writer import StreamingWriter
+from swe_filter import ShallowOneKalman
+import run_filter_swe_1d_bump
+from run_filter_swe_1d_bump import (collect_staged, control, init_worker, is_complete,
+                                    load_checkpoint, load_data, model_config, obs_indices,
+                                    output_name, run_model, save_checkpoint, share_data,
+                                    staging_dir)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def write_data(data_file, t_final):
+    t = np.arange(0., t_final + 2 * control["dt"], control["dt"])
+    x = np.linspace(0., 10_000., control["nx"] + 1)
+    h = 4. + 0.1 * np.sin(2 * np.pi * t / 600.)[:, np.newaxis] * np.ones_like(x)
+    dat = xr.Dataset({"h": (("t", "x"), h)}, coords=dict(t=t, x=x),
+                     attrs=dict(shore_height=5.))
+    dat.to_netcdf(data_file)
+
+
+def test_is_complete(tmp_path):
+    output_file = str(tmp_path / "output.h5")
+    assert not is_complete(output_file)
+
+    with h5py.File(output_file, "w") as f:
+        f.attrs.create("failed", False)
+    assert not is_complete(output_file)
+
+    with h5py.File(output_file, "r+") as f:
+        f.attrs.create("complete", True)
+    assert is_complete(output_file)
+
+    # failed runs are re-run
+    with h5py.File(output_file, "r+") as f:
+        f.attrs.create("failed", True)
+    assert not is_complete(output_file)
+
+
+def test_collect_staged(tmp_path):
+    output_dir = str(tmp_path) + "/"
+    model_args = dict(layouts=[(5, 30), (11, 30)], k=4, s=1000., nu=1., linear=True,
+                      output_dir=output_dir, posterior=False, enkf=False)
+    stems = [output_name(nx_obs, nt_skip, 4, 1000., 1., True, False)
+             for nx_obs, nt_skip in model_args["layouts"]]
+
+    def stage(rank):
+        staged = staging_dir(output_dir, rank)
+        os.makedirs(staged, exist_ok=True)
+        for stem in stems:
+            for name in [stem, stem.replace(".h5", "-checkpoint.h5.tmp")]:
+                open(staged + name, "w").close()
+
+        return staged
+
+    # the first copy is moved into place, and the other deleted
+    staged_first, staged_other = stage(1), stage(2)
+    collect_staged(model_args, 1, keep=True)
+    collect_staged(model_args, 2, keep=False)
+    for stem in stems:
+        assert os.path.exists(output_dir + stem)
+    assert os.listdir(staged_first) == [] and os.listdir(staged_other) == []
+
+
+def test_shared_data(tmp_path, monkeypatch):
+    data_file = str(tmp_path / "data.nc")
+    write_data(data_file, 30.)
+    dat = xr.open_dataset(data_file)
+
+    layouts = [5, 11]
+    blocks, desc = share_data(data_file, [obs_indices(n) for n in layouts])
+    monkeypatch.setattr(run_filter_swe_1d_bump, "shared_data", None)
+    init_worker(desc)
+    worker_blocks = run_filter_swe_1d_bump.shared_data["blocks"]
+    try:
+        for nx_obs in layouts:
+            idx_obs = obs_indices(nx_obs)
+            t, x, h_obs, shore_height = load_data(data_file, idx_obs)
+            assert_array_equal(t, dat.coords["t"].values)
+            assert_array_equal(h_obs, dat["h"][:, idx_obs].values)
+            assert shore_height == 5.
+
+            # each layout's columns are a (read-only) view of their own block
+            block = worker_blocks[2 + layouts.index(nx_obs)]
+            assert h_obs.flags.c_contiguous and not h_obs.flags.writeable
+            assert np.shares_memory(h_obs, np.ndarray(h_obs.shape, h_obs.dtype, block.buf))
+    finally:
+        for block in worker_blocks:
+            block.close()
+        for block in blocks:
+            block.close()
+            block.unlink()
+        dat.close()
+
+
+def test_checkpoint_round_trip(tmp_path):
+    model_control, stat_params, params = model_config(4, 1000., 1.)
+    model_control = dict(model_control, nx=32)
+    x_obs = np.linspace(1000., 2000., 5)[:, np.newaxis]
+
+    swe = ShallowOneKalman(model_control, params, stat_params, lr=True)
+    H = build_observation_operator(x_obs, swe.W, sub=1, out="scipy")
+    for i in range(3):
+        swe.prediction_step((i + 1) * swe.dt)
+        swe.assimilate(4. * np.ones((5, )), H, 5e-2)
+        swe.set_prev()
+
+    checkpoint_file = str(tmp_path / "checkpoint.h5")
+    counters = dict(i=3, t=3., i_save=1, i_update=3, t_checkpoint=2.)
+    mean_checkpoint, cov_sqrt_checkpoint = swe.mean.copy(), swe.cov_sqrt.copy()
+    save_checkpoint(checkpoint_file, swe, mean_checkpoint, cov_sqrt_checkpoint, counters)
+    draws = np.random.normal(size=(10, ))
+    assert not os.path.exists(checkpoint_file + ".tmp")
+
+    swe_loaded = ShallowOneKalman(model_control, params, stat_params, lr=True)
+    counters_loaded, mean_loaded, cov_sqrt_loaded = load_checkpoint(
+        checkpoint_file, swe_loaded)
+
+    # counters keep their types, and the RNG picks up where it was saved
+    assert counters_loaded == counters
+    assert all(type(counters_loaded[name]) == int for name in ["i", "i_save", "i_update"])
+    assert_array_equal(np.random.normal(size=(10, )), draws)
+
+    assert_array_equal(mean_loaded, mean_checkpoint)
+    assert_array_equal(cov_sqrt_loaded, cov_sqrt_checkpoint)
+    assert_array_equal(swe_loaded.mean, swe.mean)
+    assert_array_equal(swe_loaded.cov_sqrt, swe.cov_sqrt)
+    assert_array_equal(swe_loaded.du_prev.vector().get_local(),
+                       swe.du_prev.vector().get_local())
+
+
+def test_resume(tmp_path, monkeypatch):
+    t_final, nx_obs, nt_skip = 30., 5, 5
+    data_file = str(tmp_path / "data.nc")
+    write_data(data_file, t_final)
+
+    stem = output_name(nx_obs, nt_skip, 4, 1000., 1., True, True)
+    outputs = {}
+    for name in ["full", "resumed"]:
+        os.makedirs(tmp_path / name)
+        outputs[name] = str(tmp_path / name) + "/"
+
+    def run(output_dir, **kwargs):
+        return run_model(data_file, nx_obs, nt_skip, 4, 1000., 1., True, output_dir,
+                         t_final=t_final, checkpoint_interval=10, **kwargs)
+
+    run(outputs["full"])
+    assert not os.path.exists(outputs["full"] + stem.replace(".h5", "-checkpoint.h5"))
+
+    # interrupt after the second checkpoint (step 20)
+    prediction_step = ShallowOneKalman.prediction_step
+
+    def interrupted_step(self, t):
+        if t > 25.:
+            raise Interrupted()
+        prediction_step(self, t)
+
+    monkeypatch.setattr(ShallowOneKalman, "prediction_step", interrupted_step)
+    with pytest.raises(Interrupted):
+        run(outputs["resumed"])
+
+    checkpoint_file = outputs["resumed"] + stem.replace(".h5", "-checkpoint.h5")
+    assert os.path.exists(checkpoint_file)
+    with h5py.File(checkpoint_file, "r") as f:
+        assert f.attrs["i"] == 20
+    with h5py.File(outputs["resumed"] + stem, "r") as f:
+        assert not f.attrs.get("complete", False)
+
+    # resume (from step 20) in the reopened, partially streamed outputs
+    monkeypatch.undo()
+    run(outputs["resumed"], resume=True)
+    assert not os.path.exists(checkpoint_file)
+
+    with h5py.File(outputs["full"] + stem, "r") as full, \
+            h5py.File(outputs["resumed"] + stem, "r") as resumed:
+        assert resumed.attrs["complete"] and not resumed.attrs["failed"]
+        for name in ["t", "t_obs", "rank", "rmse", "rmse_rel", "lml",
+                     "u_mean", "h_mean", "u_var", "h_var",
+                     "mean_checkpoint", "cov_sqrt_checkpoint"]:
+            assert resumed[name].shape == full[name].shape
+            assert_allclose(resumed[name][()], full[name][()], atol=1e-12)
+
+
+def test_interrupted_cleanup(tmp_path, monkeypatch):
+    data_file = str(tmp_path / "data.nc")
+    write_data(data_file, 30.)
+
+    def interrupted_step(self, t):
+        raise Interrupted()
+
+    # failures in closing the outputs don't mask the interruption
+    close = StreamingWriter.close
+
+    def failing_close(self):
+        close(self)
+        raise RuntimeError("Output writer failed")
+
+    monkeypatch.setattr(ShallowOneKalman, "prediction_step", interrupted_step)
+    monkeypatch.setattr(StreamingWriter, "close", failing_close)
+    with pytest.raises(Interrupted):
+        run_model(data_file, 5, 5, 4, 1000., 1., True, str(tmp_path) + "/",
+                  t_final=30., smooth=True)
+
+    # and everything is still closed
+    assert len(h5py.h5f.get_obj_ids(types=h5py.h5f.OBJ_FILE)) == 0
@@ -96,3 +96,23 @@ def test_shallowone_vertices():
 
     assert_allclose(u, 2 * np.sin(swe.x_coords.flatten()))
     assert_allclose(h, 2 * np.cos(swe.x_coords.flatten()))
+
+
+def test_shallowone_linear_prefactored():
+    control = {"nx": 32, "dt": 1., "theta": 0.6, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    swe = ShallowOneLinear(control, params)
+
+    control["prefactored"] = True
+    swe_prefactored = ShallowOneLinear(control, params)
+
+    # direct stepping should agree with the variational solver
+    t = 0.
+    for i in range(20):
+        t += swe.dt
+        swe.solve(t)
+        swe_prefactored.solve(t)
+        assert_allclose(swe_prefactored.du.vector().get_local(),
+                        swe.du.vector().get_local(), atol=1e-10)
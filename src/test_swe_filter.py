@@ -4,12 +4,16 @@ import numpy as np
 import fenics as fe
 
 from numpy.testing import assert_allclose
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, random as sparse_random, eye as sparse_eye
+from scipy.sparse.linalg import splu
+from scipy.stats import multivariate_normal
 
 from statfenics.covariance import sq_exp_covariance, sq_exp_evd, sq_exp_evd_hilbert
-from statfenics.utils import dolfin_to_csr
+from statfenics.utils import dolfin_to_csr, build_observation_operator
 
-from swe_filter import ShallowOneEx, ShallowOneKalman
+import swe_filter
+from swe_filter import (ShallowOneEx, ShallowOneKalman, ShallowOneEnKF, ReusableLU,
+                        MatrixFreeSolver)
 
 
 def test_1d_linear_filter():
@@ -102,6 +106,14 @@ def test_1d_nonlinear_filter():
         assert_allclose(swe.J_scipy.indices, jacobian_alt.indices)
         assert_allclose(swe.J_scipy.indptr, jacobian_alt.indptr)
 
+    # check in-place assembly against a fresh assembly (w/BCs applied)
+    for J_form, J_scipy in [(swe.J, swe.J_scipy), (swe.J_prev, swe.J_prev_scipy)]:
+        J = fe.assemble(J_form)
+        for bc in swe.bcs:
+            bc.apply(J)
+
+        assert_allclose(J_scipy.todense(), dolfin_to_csr(J).todense())
+
 
 def test_1d_filter_lr():
     k = 16
@@ -175,3 +187,678 @@ def test_1d_filter_lr():
     # regression test to see that computations are the same
     np.testing.assert_allclose(np.linalg.norm(G_sqrt - G_sqrt_hilbert),
                                2572.199803)
+
+
+def test_reusable_lu(monkeypatch):
+    # count the numeric factorisations
+    n_splu = [0]
+
+    def counted_splu(*args, **kwargs):
+        n_splu[0] += 1
+        return splu(*args, **kwargs)
+
+    monkeypatch.setattr(swe_filter, "splu", counted_splu)
+
+    np.random.seed(27)
+    n = 50
+    A = (sparse_random(n, n, density=0.1, random_state=27)
+         + 10 * sparse_eye(n)).tocsr()
+    b = np.random.normal(size=(n, 3))
+
+    # exact: refactorised on each update
+    lu = ReusableLU()
+    for i in range(5):
+        A.data[:] += 1e-3 * np.random.normal(size=A.data.shape)
+        lu.update(A)
+        assert_allclose(A @ lu.solve(b), b, atol=1e-10)
+
+    assert lu.n_factorizations == 5
+    assert lu.refactorization_rate == 1.
+
+    # the first factorisation (which picks the ordering) is kept
+    assert n_splu[0] == 5
+
+    # stale: small perturbations are absorbed by refinement
+    lu = ReusableLU(stale_tol=1e-10, max_iter=5)
+    for i in range(5):
+        A.data[:] += 1e-3 * np.random.normal(size=A.data.shape)
+        lu.update(A)
+        assert_allclose(A @ lu.solve(b), b, atol=1e-8)
+
+    assert lu.n_factorizations == 1
+    assert lu.n_updates == 5
+
+    # large perturbations force a refactorisation
+    A.data[:] *= 1 + np.random.uniform(size=A.data.shape)
+    lu.update(A)
+    assert_allclose(A @ lu.solve(b), b, atol=1e-8)
+    assert lu.n_factorizations == 2
+
+
+def test_matrix_free_solver():
+    np.random.seed(27)
+    n = 50
+    A = (sparse_random(n, n, density=0.1, random_state=27)
+         + 10 * sparse_eye(n)).tocsr()
+    B = np.random.normal(size=(n, 3))
+
+    # slowly varying operators re-use the preconditioner
+    solver = MatrixFreeSolver(A, A.copy, tol=1e-10, max_iter=5)
+    for i in range(10):
+        A.data[:] += 1e-4 * np.random.normal(size=A.data.shape)
+        assert_allclose(A @ solver.solve(B), B, atol=1e-8)
+
+    assert solver.n_refreshes == 1
+
+    # and large changes refresh it
+    A.data[:] *= 1 + np.random.uniform(size=A.data.shape)
+    assert_allclose(A @ solver.solve(B), B, atol=1e-8)
+    assert solver.n_refreshes == 2
+
+    # solves that converge on the last refinement don't refresh it
+    solver = MatrixFreeSolver(A, A.copy, tol=1e-10, max_iter=1)
+    solver.solve(B)
+    A.data[:] += 1e-6 * np.random.normal(size=A.data.shape)
+    assert_allclose(A @ solver.solve(B), B, atol=1e-8)
+    assert solver.n_refreshes == 1
+
+
+def test_1d_filter_lr_reduction():
+    k = 4
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False,
+                       reduction="threshold", k_max=k + 2 * 2 * k)
+
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+    assert swe.cov_sqrt_pred.shape == (swe.n_dofs, 3 * k)
+
+    # no reduction until the rank exceeds k_max
+    t = 0.
+    for rank in [3 * k, 5 * k, k, 3 * k]:
+        t += swe.dt
+        swe.prediction_step(t)
+        swe.set_prev()
+        assert swe.cov_sqrt.shape == (swe.n_dofs, rank)
+        assert swe.cov_sqrt_prev.shape == (swe.n_dofs, rank)
+
+    # deferred steps are exact
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+    Q = swe.A_scipy_lu.solve(swe.dt * swe.G_sqrt)
+    A_prev_Q = swe.A_scipy_lu.solve(swe.A_prev_scipy @ Q)
+    for i in range(2):
+        swe.prediction_step(t)
+        swe.set_prev()
+
+    assert_allclose(swe.cov_sqrt @ swe.cov_sqrt.T,
+                    A_prev_Q @ A_prev_Q.T + Q @ Q.T, atol=1e-10)
+
+    # and reduction at observation times goes back to rank k
+    swe.reduce_cov_sqrt()
+    assert swe.cov_sqrt.shape == (swe.n_dofs, k)
+
+    # deferred reductions need an explicit k_max
+    stat_params.update(k_max=None)
+    with pytest.raises(ValueError):
+        ShallowOneKalman(control, params, stat_params, lr=True)
+
+    # and k_max can't be so small that every step is reduced
+    stat_params.update(k_max=k + 2 * k - 1)
+    with pytest.raises(ValueError):
+        ShallowOneKalman(control, params, stat_params, lr=True)
+
+
+def test_1d_filter_lr_deferred_reduction_cost():
+    k, nt_skip = 8, 4
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=1, k_init_h=1, hilbert_gp=False)
+
+    # reduce at observation times, as in run_filter
+    k_noise = ShallowOneKalman(control, params, stat_params, lr=True).k_noise
+    filters = {}
+    for reduction in ["step", "obs"]:
+        swe = ShallowOneKalman(control, params,
+                               dict(stat_params, reduction=reduction,
+                                    k_max=k + (nt_skip - 1) * k_noise),
+                               lr=True)
+
+        t = 0.
+        for i in range(4 * nt_skip):
+            t += swe.dt
+            swe.prediction_step(t)
+            if i % nt_skip == 0 and swe.reduction == "obs":
+                swe.reduce_cov_sqrt()
+            swe.set_prev()
+
+        filters[reduction] = swe
+
+    # with little noise per step, deferring does fewer and cheaper reductions
+    step, obs = filters["step"], filters["obs"]
+    assert step.n_reductions == 4 * nt_skip
+    assert obs.n_reductions < step.n_reductions
+    assert obs.reduction_cost < step.reduction_cost
+
+
+def test_1d_filter_lr_adaptive_rank():
+    k = 8
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False,
+                       var_target=0.99, k_min=2, k_max=24)
+
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+    t = 0.
+    for i in range(10):
+        t += swe.dt
+        swe.prediction_step(t)
+        swe.set_prev()
+
+        # rank is within bounds, and the retained variance is as required
+        rank = swe.cov_sqrt.shape[1]
+        assert 2 <= rank <= 24
+        if rank < 24:
+            var_kept = np.sum(swe.cov_sqrt**2) / np.sum(swe.cov_sqrt_pred**2)
+            assert var_kept >= 0.99
+
+    # with only the target set, the rank bounds default to [1, k + k_noise]
+    stat_params = {name: val for name, val in stat_params.items()
+                   if name not in ["k_min", "k_max"]}
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+    assert (swe.k_min, swe.k_max) == (1, k + 2 * k)
+
+    ranks = []
+    t = 0.
+    for i in range(10):
+        t += swe.dt
+        swe.prediction_step(t)
+        swe.set_prev()
+        ranks.append(swe.cov_sqrt.shape[1])
+
+    assert any(rank != k for rank in ranks)
+
+    # and fixed bounds leave nothing to adapt
+    stat_params.update(k_min=k, k_max=k)
+    with pytest.raises(ValueError):
+        ShallowOneKalman(control, params, stat_params, lr=True)
+
+
+def test_1d_filter_lr_assimilate():
+    k = 8
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False)
+
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+    swe_fused = ShallowOneKalman(control, params, stat_params, lr=True)
+
+    x_obs = np.linspace(1000., 2000., 5)[:, np.newaxis]
+    H = build_observation_operator(x_obs, swe.W, sub=1, out="scipy")
+    sigma_y = 5e-2
+
+    t = 0.
+    for i in range(5):
+        t += swe.dt
+        for s in [swe, swe_fused]:
+            s.prediction_step(t)
+
+        y = 4. + sigma_y * np.random.normal(size=(5, ))
+        S = H @ swe.cov_sqrt @ swe.cov_sqrt.T @ H.T + (sigma_y**2 + 1e-10) * np.eye(5)
+        lml_true = multivariate_normal(H @ swe.mean, S).logpdf(y)
+
+        lml = swe.compute_lml(y, H, sigma_y)
+        correction = swe.update_step(y, H, sigma_y, return_correction=True)
+        lml_fused, correction_fused = swe_fused.assimilate(y, H, sigma_y)
+
+        assert_allclose(lml, lml_true)
+        assert_allclose(lml_fused, lml)
+        assert_allclose(correction_fused, correction)
+        assert_allclose(swe_fused.mean, swe.mean)
+        assert_allclose(swe_fused.cov_sqrt, swe.cov_sqrt)
+
+        for s in [swe, swe_fused]:
+            s.set_prev()
+
+
+def test_1d_filter_lr_woodbury():
+    k = 4
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False)
+
+    stat_params.update(update_form="batch")
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+    stat_params.update(update_form="auto")
+    swe_woodbury = ShallowOneKalman(control, params, stat_params, lr=True)
+
+    # observe every vertex (n_obs > k), with heteroscedastic noise
+    H = build_observation_operator(swe.x_coords, swe.W, sub=1, out="scipy")
+    sigma_y = np.linspace(1e-2, 1e-1, H.shape[0])
+
+    t = 0.
+    for i in range(5):
+        t += swe.dt
+        for s in [swe, swe_woodbury]:
+            s.prediction_step(t)
+
+        y = 4. + sigma_y * np.random.normal(size=sigma_y.shape)
+        lml, correction = swe.assimilate(y, H, sigma_y)
+        lml_woodbury, correction_woodbury = swe_woodbury.assimilate(y, H, sigma_y)
+        assert swe.form == "batch"
+        assert swe_woodbury.form == "woodbury"
+
+        assert_allclose(lml_woodbury, lml)
+        assert_allclose(correction_woodbury, correction, atol=1e-10)
+        assert_allclose(swe_woodbury.cov_sqrt @ swe_woodbury.cov_sqrt.T,
+                        swe.cov_sqrt @ swe.cov_sqrt.T, atol=1e-10)
+
+        for s in [swe, swe_woodbury]:
+            s.set_prev()
+
+
+def test_1d_filter_lr_serial():
+    k = 8
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False)
+
+    stat_params.update(update_form="batch")
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+    stat_params.update(update_form="serial")
+    swe_serial = ShallowOneKalman(control, params, stat_params, lr=True)
+
+    x_obs = np.linspace(1000., 2000., 5)[:, np.newaxis]
+    H = build_observation_operator(x_obs, swe.W, sub=1, out="scipy")
+    sigma_y = 5e-2
+
+    t = 0.
+    for i in range(5):
+        t += swe.dt
+        for s in [swe, swe_serial]:
+            s.prediction_step(t)
+
+        y = 4. + sigma_y * np.random.normal(size=(5, ))
+        assert_allclose(swe_serial.compute_lml(y, H, sigma_y),
+                        swe.compute_lml(y, H, sigma_y))
+
+        lml, correction = swe.assimilate(y, H, sigma_y)
+        lml_serial, correction_serial = swe_serial.assimilate(y, H, sigma_y)
+
+        assert_allclose(lml_serial, lml)
+        assert_allclose(correction_serial, correction, atol=1e-10)
+        assert_allclose(swe_serial.mean, swe.mean, atol=1e-10)
+        assert_allclose(swe_serial.cov_sqrt @ swe_serial.cov_sqrt.T,
+                        swe.cov_sqrt @ swe.cov_sqrt.T, atol=1e-10)
+
+        for s in [swe, swe_serial]:
+            s.set_prev()
+
+
+def test_1d_enkf():
+    k = 8
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=0., ell_u=5000.,
+                       rho_h=1e-2, ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False)
+    swe = ShallowOneEnKF(control, params, stat_params)
+    assert swe.ens.shape == (swe.n_dofs, k)
+
+    x_obs = np.linspace(1000., 2000., 5)[:, np.newaxis]
+    H = build_observation_operator(x_obs, swe.W, sub=1, out="scipy")
+    sigma_y = 5e-2
+
+    t = 0.
+    for i in range(5):
+        t += swe.dt
+        swe.prediction_step(t)
+
+        # members have spread, and moments are consistent
+        assert np.linalg.norm(swe.cov_sqrt) > 0.
+        assert_allclose(np.mean(swe.ens, axis=1), swe.mean)
+
+        # update keeps the ensemble consistent with the moments
+        y = 4. + sigma_y * np.random.normal(size=(5, ))
+        cov_prior = swe.cov_sqrt @ swe.cov_sqrt.T
+        HC = H @ cov_prior
+        S = HC @ H.T + (sigma_y**2 + 1e-10) * np.eye(5)
+        cov_post = cov_prior - HC.T @ np.linalg.solve(S, HC)
+
+        swe.assimilate(y, H, sigma_y)
+        anomalies = swe.ens - np.mean(swe.ens, axis=1)[:, np.newaxis]
+        assert_allclose(np.mean(swe.ens, axis=1), swe.mean, atol=1e-10)
+        assert_allclose(anomalies @ anomalies.T / (k - 1), cov_post, atol=1e-10)
+        swe.set_prev()
+
+
+def test_1d_filter_lr_matrix_free():
+    k = 8
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False)
+    swe = ShallowOneEx(control, params, stat_params, lr=True)
+
+    control["matrix_free"] = True
+    swe_mf = ShallowOneEx(control, params, stat_params, lr=True)
+
+    # no assembled Jacobians are kept
+    assert not hasattr(swe_mf, "J_scipy") and not hasattr(swe_mf, "J_prev_scipy")
+
+    # actions agree with the assembled Jacobians
+    X = np.random.normal(size=(swe.n_dofs, 3))
+    swe.assemble_derivatives()
+    assert_allclose(swe_mf.J_action @ X, swe.J_scipy @ X, atol=1e-10)
+    assert_allclose(swe_mf.J_prev_action @ X, swe.J_prev_scipy @ X, atol=1e-10)
+
+    t = 0.
+    for i in range(5):
+        t += swe.dt
+        for s in [swe, swe_mf]:
+            s.prediction_step(t)
+            s.set_prev()
+
+        assert_allclose(swe_mf.mean, swe.mean)
+        assert_allclose(swe_mf.cov_sqrt @ swe_mf.cov_sqrt.T,
+                        swe.cov_sqrt @ swe.cov_sqrt.T, atol=1e-8)
+
+    # preconditioner is re-used across steps (as factors only)
+    assert swe_mf.J_mf_solver.n_refreshes < 5
+    assert swe_mf.J_mf_solver.pc.A is None
+
+
+def test_1d_filter_lr_doubling():
+    k = 4
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False,
+                       reduction="threshold", k_max=k + 7 * 2 * k)
+
+    # exact propagation over 7 steps (no reduction), then truncation
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+    t = 0.
+    for i in range(7):
+        t += swe.dt
+        swe.prediction_step(t)
+        swe.set_prev()
+
+    swe.reduce_cov_sqrt()
+    cov_exact = swe.cov_sqrt @ swe.cov_sqrt.T
+
+    # jump straight there, with no loss in the noise compression
+    stat_params.update(reduction="step", k_max=k,
+                       cov_doubling=True, k_doubling=swe.n_dofs)
+    swe_doubling = ShallowOneKalman(control, params, stat_params, lr=True)
+    t = 0.
+    for i in range(7):
+        t += swe_doubling.dt
+        swe_doubling.prediction_step(t)
+        swe_doubling.set_prev()
+
+    assert swe_doubling.n_cov_pending == 7
+    swe_doubling.sync_cov_sqrt()
+    assert swe_doubling.n_cov_pending == 0
+    assert len(swe_doubling.Phi_pows) == 3
+
+    assert_allclose(swe_doubling.mean, swe.mean)
+    assert_allclose(swe_doubling.cov_sqrt @ swe_doubling.cov_sqrt.T, cov_exact,
+                    atol=1e-8)
+
+
+def test_1d_filter_lr_steady_state():
+    k = 4
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False)
+
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+
+    stat_params.update(steady_state=True, ss_tol=1e-10, ss_nis_tol=np.inf)
+    swe_ss = ShallowOneKalman(control, params, stat_params, lr=True)
+    swe_offline = ShallowOneKalman(control, params, stat_params, lr=True)
+
+    x_obs = np.linspace(1000., 2000., 5)[:, np.newaxis]
+    H = build_observation_operator(x_obs, swe.W, sub=1, out="scipy")
+    sigma_y = 5e-2
+
+    swe_offline.precompute_steady_state(H, sigma_y, nt_skip=1)
+    assert swe_offline.frozen
+    assert_allclose(swe_offline.du.vector().get_local(),
+                    swe.du.vector().get_local())
+
+    def assert_cov_close(swe_ss, swe):
+        cov = swe.cov_sqrt @ swe.cov_sqrt.T
+        assert_allclose(swe_ss.cov_sqrt @ swe_ss.cov_sqrt.T, cov,
+                        atol=1e-6 * np.abs(cov).max())
+
+    t = 0.
+    for i in range(200):
+        t += swe.dt
+        for s in [swe, swe_ss]:
+            s.prediction_step(t)
+
+        # frozen filters report the steady-state prior, then posterior
+        if swe_ss.frozen:
+            assert_cov_close(swe_ss, swe)
+
+        y = 4. + sigma_y * np.random.normal(size=(5, ))
+        lml, correction = swe.assimilate(y, H, sigma_y)
+        lml_ss, correction_ss = swe_ss.assimilate(y, H, sigma_y)
+
+        assert_allclose(lml_ss, lml, rtol=1e-6)
+        assert_allclose(correction_ss, correction, atol=1e-6)
+        if swe_ss.frozen:
+            assert_cov_close(swe_ss, swe)
+
+        for s in [swe, swe_ss]:
+            s.set_prev()
+
+    # same gain online and offline
+    assert swe_ss.frozen
+    assert_allclose(swe_ss.K_ss, swe_offline.K_ss, atol=1e-8)
+
+    # with reductions at observation times, the offline gain is reduced
+    # as the online one is
+    stat_params.update(reduction="obs", k_max=k + 2 * 2 * k)
+    swe_ss = ShallowOneKalman(control, params, stat_params, lr=True)
+    swe_offline = ShallowOneKalman(control, params, stat_params, lr=True)
+    swe_offline.precompute_steady_state(H, sigma_y, nt_skip=2)
+    assert swe_offline.frozen
+
+    t = 0.
+    for i in range(400):
+        t += swe_ss.dt
+        swe_ss.prediction_step(t)
+        if i % 2 == 0:
+            swe_ss.reduce_cov_sqrt()
+            swe_ss.assimilate(4. + sigma_y * np.random.normal(size=(5, )), H, sigma_y)
+        swe_ss.set_prev()
+
+    assert swe_ss.frozen
+    assert_allclose(swe_ss.K_ss, swe_offline.K_ss, atol=1e-8)
+
+
+def test_1d_filter_basis_cache(tmp_path):
+    k = 4
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=True)
+
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+
+    stat_params.update(basis_cache_dir=str(tmp_path))
+    swe_store = ShallowOneKalman(control, params, stat_params, lr=True)
+    assert len(list(tmp_path.glob("G_sqrt_u-*.npy"))) == 1
+    assert len(list(tmp_path.glob("G_sqrt_h-*.npy"))) == 1
+    assert len(list(tmp_path.glob("M_w-*.npz"))) == 1
+
+    # second construction is read straight from the cache
+    swe_load = ShallowOneKalman(control, params, stat_params, lr=True)
+    assert all(isinstance(factor, np.memmap) for _, factor in swe_load.noise.blocks)
+    assert_allclose(swe_store.G_sqrt, swe.G_sqrt)
+    assert_allclose(swe_load.G_sqrt, swe.G_sqrt)
+
+    # new hyperparameters give a new entry, for that field only
+    stat_params.update(ell_h=1000.)
+    ShallowOneKalman(control, params, stat_params, lr=True)
+    assert len(list(tmp_path.glob("G_sqrt_u-*.npy"))) == 1
+    assert len(list(tmp_path.glob("G_sqrt_h-*.npy"))) == 2
+
+
+def test_1d_filter_block_noise():
+    k = 4
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=0., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=True)
+
+    # zero-variance velocity noise is dropped entirely
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+    assert swe.k_noise == k
+    assert swe.G_sqrt.shape == (swe.n_dofs, k)
+    np.testing.assert_allclose(swe.G_sqrt[swe.u_dofs, :], 0.)
+
+    z = np.random.normal(size=(k, 3))
+    np.testing.assert_allclose(swe.noise @ z, swe.G_sqrt @ z)
+
+    # as are its columns in the prediction
+    swe.prediction_step(swe.dt)
+    assert swe.cov_sqrt_pred.shape == (swe.n_dofs, 2 * k)
+
+
+def test_1d_filter_lr_float32():
+    k = 8
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False)
+
+    for update_form in ["batch", "woodbury", "serial"]:
+        stat_params.update(dtype="float64", update_form=update_form)
+        swe = ShallowOneKalman(control, params, stat_params, lr=True)
+        stat_params.update(dtype="float32")
+        swe_single = ShallowOneKalman(control, params, stat_params, lr=True)
+        assert swe_single.cov_sqrt.dtype == np.float32
+        assert swe_single.cov_sqrt_pred.dtype == np.float32
+
+        x_obs = np.linspace(1000., 2000., 5)[:, np.newaxis]
+        H = build_observation_operator(x_obs, swe.W, sub=1, out="scipy")
+        sigma_y = 5e-2
+
+        t = 0.
+        for i in range(20):
+            t += swe.dt
+            for s in [swe, swe_single]:
+                s.prediction_step(t)
+
+            y = 4. + sigma_y * np.random.normal(size=(5, ))
+            lml, correction = swe.assimilate(y, H, sigma_y)
+            lml_single, correction_single = swe_single.assimilate(y, H, sigma_y)
+
+            assert swe_single.cov_sqrt.dtype == np.float32
+            assert_allclose(lml_single, lml, rtol=1e-4)
+            assert_allclose(swe_single.mean, swe.mean, rtol=1e-4, atol=1e-6)
+            assert_allclose(swe_single.cov_sqrt @ swe_single.cov_sqrt.T,
+                            swe.cov_sqrt @ swe.cov_sqrt.T,
+                            rtol=1e-3, atol=1e-6 * np.max(swe.cov_sqrt**2))
+
+            for s in [swe, swe_single]:
+                s.set_prev()
+
+        # the propagator is cast once, and the variances are (blocked) as usual
+        assert swe_single.A_cast[0] is swe_single.A_prev_scipy
+        assert swe_single.A_cast[1].dtype == np.float32
+        assert_allclose(swe_single.marginal_var(H), np.sum((H @ swe.cov_sqrt)**2, axis=1),
+                        rtol=1e-3)
+
+
+def test_1d_filter_state_dict():
+    k = 4
+    control = {"nx": 32, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=k, k_init_u=k, k_init_h=k, hilbert_gp=False)
+
+    x_obs = np.linspace(1000., 2000., 5)[:, np.newaxis]
+    sigma_y = 5e-2
+    ys = 4. + sigma_y * np.random.normal(size=(10, 5))
+
+    def run(swe, steps, t):
+        H = build_observation_operator(x_obs, swe.W, sub=1, out="scipy")
+        for i in steps:
+            t += swe.dt
+            swe.prediction_step(t)
+            if i % 2 == 0:
+                swe.assimilate(ys[i], H, sigma_y)
+
+            swe.set_prev()
+
+        return t
+
+    for cls in [ShallowOneEx, ShallowOneKalman]:
+        swe = cls(control, params, stat_params, lr=True)
+        run(swe, range(10), 0.)
+
+        # interrupt after 5 steps, and resume in a new filter
+        swe_first = cls(control, params, stat_params, lr=True)
+        t = run(swe_first, range(5), 0.)
+        state = {name: np.copy(val) for name, val in swe_first.state_dict().items()}
+
+        swe_resumed = cls(control, params, stat_params, lr=True)
+        swe_resumed.load_state_dict(state)
+        run(swe_resumed, range(5, 10), t)
+
+        np.testing.assert_array_equal(swe_resumed.mean, swe.mean)
+        np.testing.assert_array_equal(swe_resumed.cov_sqrt, swe.cov_sqrt)
+        np.testing.assert_array_equal(swe_resumed.du_prev.vector().get_local(),
+                                      swe.du_prev.vector().get_local())
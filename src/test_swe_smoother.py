@@ -0,0 +1,83 @@
+import numpy as np
+
+from numpy.testing import assert_allclose
+from statfenics.utils import build_observation_operator
+from swe_filter import ShallowOneKalman
+from swe_smoother import RTSSmoother
+
+
+def test_1d_rts_smoother(tmp_path):
+    control = {"nx": 8, "dt": 1., "theta": 1.0, "simulation": "tidal_flow"}
+    params = {"nu": 1.0,
+              "shore_start": 1000, "shore_height": 5,
+              "bump_height": 0, "bump_width": 100, "bump_centre": 1000.}
+    stat_params = dict(rho_u=1., ell_u=5000.,
+                       rho_h=1., ell_h=5000.,
+                       k=4, k_init_u=4, k_init_h=4, hilbert_gp=False)
+
+    # full rank, so that the low-rank smoother is exact
+    n_dofs = ShallowOneKalman(control, params, stat_params, lr=True).n_dofs
+    stat_params.update(k=n_dofs)
+    swe = ShallowOneKalman(control, params, stat_params, lr=True)
+
+    x_obs = np.linspace(1000., 2000., 3)[:, np.newaxis]
+    H = build_observation_operator(x_obs, swe.W, sub=1, out="scipy").toarray()
+    sigma_y = 5e-2
+
+    F = swe.A_scipy_lu.solve(swe.A_prev_scipy.toarray())
+    Q_sqrt = swe.A_scipy_lu.solve(swe.dt * swe.G_sqrt)
+    Q = Q_sqrt @ Q_sqrt.T
+
+    nt = 10
+    smoother = RTSSmoother(swe, str(tmp_path / "history.h5"), nt, dtype=np.float64)
+    smoother_f32 = RTSSmoother(swe, str(tmp_path / "history-f32.h5"), nt, keep=True)
+    for s in [smoother, smoother_f32]:
+        s.record_initial()
+
+    means, covs = [swe.mean.copy()], [np.zeros((n_dofs, n_dofs))]
+    means_pred, covs_pred = [], []
+    t = 0.
+    for i in range(nt):
+        t += swe.dt
+        swe.prediction_step(t)
+        for s in [smoother, smoother_f32]:
+            s.record_prediction(i)
+        means_pred.append(swe.mean.copy())
+        covs_pred.append(F @ covs[-1] @ F.T + Q)
+
+        if i % 3 == 0:
+            y = 4. + sigma_y * np.random.normal(size=(3, ))
+            swe.assimilate(y, H, sigma_y)
+            for s in [smoother, smoother_f32]:
+                s.record_update()
+
+        means.append(swe.mean.copy())
+        covs.append(swe.cov_sqrt @ swe.cov_sqrt.T)
+        swe.set_prev()
+
+    # dense RTS on the filtered moments
+    smoothed = {i: (mean, cov_sqrt) for i, mean, cov_sqrt in smoother.backward()}
+    smoothed_f32 = {i: (mean, cov_sqrt) for i, mean, cov_sqrt in smoother_f32.backward()}
+    for s in [smoother, smoother_f32]:
+        s.close()
+
+    # history is deleted, unless asked for
+    assert not (tmp_path / "history.h5").exists()
+    assert (tmp_path / "history-f32.h5").exists()
+
+    mean_smooth, cov_smooth = means[-1], covs[-1]
+    for i in reversed(range(nt)):
+        J = covs[i] @ F.T @ np.linalg.pinv(covs_pred[i])
+        mean_smooth = means[i] + J @ (mean_smooth - means_pred[i])
+        cov_smooth = covs[i] + J @ (cov_smooth - covs_pred[i]) @ J.T
+
+        mean, cov_sqrt = smoothed[i]
+        assert_allclose(mean, mean_smooth, atol=1e-8)
+        assert_allclose(cov_sqrt @ cov_sqrt.T, cov_smooth,
+                        atol=1e-8 * np.max(np.abs(cov_smooth)))
+
+        # single-precision history
+        mean, cov_sqrt = smoothed_f32[i]
+        assert_allclose(mean, mean_smooth, atol=1e-4 * np.max(np.abs(mean_smooth)))
+        assert_allclose(cov_sqrt @ cov_sqrt.T, cov_smooth,
+                        atol=1e-4 * np.max(np.abs(cov_smooth)))